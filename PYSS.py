@@ -6,57 +6,150 @@ import os
 import sys
 import json
 import imghdr
+import hashlib
+import shutil
 import threading
+import bisect
+import binascii
+import mmap
+import signal
+import subprocess
 import multiprocessing
 import codecs
+import cProfile
+import re
+import select
+import sqlite3
+import Queue
+import BaseHTTPServer
+import urlparse
 import requests
-import pickle
-from pyquery import PyQuery
-from pydub import AudioSegment
-from pydub.silence import detect_silence
-from mutagen import MutagenError
-from mutagen.id3 import ID3, APIC
-from mutagen.easyid3 import EasyID3
-from pydub.exceptions import TooManyMissingFrames
-
+from io import BytesIO
+from contextlib import contextmanager
+# pyquery, numpy, pydub and mutagen are imported where they are used, recording starts without them
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:  # Python 2 without the pytracemalloc backport
+    tracemalloc = None
+
+VERSION = "1.1.01"
 BLOCK_SIZE = 1024  # bytes
+WRITE_BUFFER_SIZE = 64 * 1024  # bytes held in memory before hitting the disk
+FSYNC_POLICY = "never"  # never, segment (on rotate/close) or flush (on every buffer flush)
+FSYNC_POLICIES = ("never", "segment", "flush")
 DJ_CHECK_INTERVAL = 5.0  # seconds
+DJ_LOOKUP_TIMEOUT = 15.0  # seconds the status and DJ pages get at startup before recording goes ahead without them
 FILE_PATH = os.getcwd()
 KEEP_CHARACTERS = (' ', '.', '_', '-')
+# Everything but letters, digits and KEEP_CHARACTERS, the same characters str.isalnum() keeps
+UNSAFE_CHARACTERS = re.compile(r"[^\w%s]" % re.escape("".join(KEEP_CHARACTERS)), re.UNICODE)
 EXTENSION = "mp3"
 TIMEOUT = 0
 VALID_ARGS = ["-load", "-save", "-timeout", "-file_path", "-block_size", "-dj_check_interval", "-dj_url",
-              "-dj_element", "-stream", "-stream_file", "-exclude_dj", "-np_element", "-cue_only"]
+              "-dj_element", "-stream", "-stream_file", "-exclude_dj", "-np_element", "-cue_only",
+              "-write_buffer", "-fsync", "-all", "-icy", "-live_silence", "-workers",
+              "-metrics_port", "-profile", "-profile_dump", "-capture", "-include",
+              "-output", "-search", "-duplicates", "-capture_port"]
 CONFIG_FILE = "config.json"
-DJ_URL = ""
-DJ_ELEMENT = ""
-DJ_IMG_ELEMENT = ""
-NP_ELEMENT = None
-CHECK_FOR_DJ = False
 WHITE_SPACE = "\r%s" % "".join([" " for x in range(78)])
 ICECAST_STATUS_LOCATION = "status-json.xsl"
-EXCLUDE_DJ = []
-CUE_ONLY = False
 SONG_CHECK_INTERVAL = .5
+DISPLAY_INTERVAL = 1.0  # seconds between redraws of the status line
+POLL_MAX_INTERVAL = 5.0  # longest wait between status polls, early in a track or after repeated errors
+POLL_GUARD = .5  # share of the learnt track length before its end polled every SONG_CHECK_INTERVAL
+POLL_FRACTION = .1  # share of the expected time left in a track waited before polling again
+POLL_LEARNING_RATE = .3  # weight of the latest track in the learnt track length
+POLL_SILENT_INTERVAL = 15.0  # seconds between status polls while a silence in the audio wakes the next one
+POLL_SILENCE_WINDOW = 5.0  # seconds polled every SONG_CHECK_INTERVAL after a silence, for the title to change
+QUERY_RETRY_MAX = 30.0  # longest wait between retries of a failing DJ page
+HTTP_TIMEOUT = 10.0  # seconds, for status, DJ page and art requests
+HTTP_HOSTS = 128  # hosts with a pool of kept alive connections
+HTTP_CONNECTIONS_PER_HOST = 4
+PAGE_TTL = 2.0  # seconds a parsed DJ page is reused before it is revalidated
+RECONNECT_DELAY = 0.25  # seconds before retrying a failed reconnect, doubled after each failure
+RECONNECT_MAX_DELAY = 30
+ART_CACHE_DIR = ".art_cache"
+ART_CACHE_SIZE = 64 * 1024 * 1024  # bytes of DJ art kept, least recently used art is dropped first
+ART_REVALIDATE = 3600  # seconds before a DJ's art is checked for changes again
+COVER_ART_FORMATS = ("m4a", "flac")  # formats ffmpeg can embed cover art in, besides mp3
+OUTPUT_PROFILES = [{"name": "original", "format": "original"}]  # every song is written once per profile
+OUTPUT_ENCODERS = {  # ffmpeg encoder, file extension and muxer by output format
+    "mp3": ("libmp3lame", "mp3", "mp3"),
+    "aac": ("aac", "m4a", "ipod"),
+    "opus": ("libopus", "opus", "opus"),
+    "vorbis": ("libvorbis", "ogg", "ogg"),
+    "flac": ("flac", "flac", "flac"),
+}
+CATALOG_FILE_NAME = "catalog.sqlite"  # index of every recorded song under the file_path
+CATALOG_TIMEOUT = 30  # seconds to wait on another writer before giving up
+SEARCH_LIMIT = 50  # newest matches listed by -search
+DUPLICATES = None  # what to do with repeat airings of a song: skip, link or cue, off unless set
+DUPLICATE_ACTIONS = ("skip", "link", "cue")
+DUPLICATES_FILE_NAME = "duplicates.jsonl"
+FINGERPRINT_RATE = 11025  # Hz, the song is decoded to mono at this rate to be fingerprinted
+FINGERPRINT_SKIP = 10  # seconds into the song before the fingerprint, past intros and DJs talking over them
+FINGERPRINT_SECONDS = 20  # seconds of the song fingerprinted
+FINGERPRINT_FRAME = 1024  # samples per spectrum, a new one every half frame
+FINGERPRINT_BANDS = (8, 16, 32, 64, 128, 256, 512)  # edges of the frequency bands a peak is picked from
+FINGERPRINT_NEIGHBOURS = 1  # frames either side a peak has to be the loudest of
+FINGERPRINT_FAN_OUT = 3  # later peaks every peak is paired with
+FINGERPRINT_ZONE = 32  # frames ahead a paired peak can be
+FINGERPRINT_MIN_MATCHES = 25  # hashes lined up at the same offset for two airings to be the same song
+COVER_ART_CACHE = 8  # cover art frames kept in memory by each post-processing worker
+STATUS_FALLBACK_INTERVAL = 10.0  # seconds between status-json polls when titles come from the stream itself
+ICY_TITLE_PATTERN = re.compile(r"StreamTitle='(.*?)';", re.DOTALL)
 CLI_LIMIT = 79
 INDEX = 0
 RESTART_ON_DJ_CHANGE = True
 PREVIOUS_SNIP = None
-SILENCE_CHECK = 100
+SILENCE_CHECK = 100  # ms of silence needed to count as a gap between songs
+SILENCE_THRESHOLD = -80  # dBFS
+SILENCE_FRAME = 10  # ms per RMS frame, the resolution of the cut
 STREAM_DELAY = 0
 SERVER_TYPES = {"audio/mpeg": "mp3"}
 MAX_DURATION = 900  # 15 minutes
 MAX_TITLE = 200  # max title length, go even less for android
-QUICK_PROC = False
-# Whether to completely calculate the silence for each song or just the first time  (~1 second per song speedup)
+SILENCE_WINDOW = 10  # seconds before a song boundary searched for silence
+SILENCE_LOOKAHEAD = 5  # seconds after a song boundary searched for silence
+COPY_CHUNK_SIZE = 256 * 1024  # bytes held in memory at a time while copying a song out of its segments
+FRAME_SEARCH_WINDOW = 8192  # bytes searched for the next MPEG frame header, several frames at any bitrate
+MPEG_BITRATES = {  # kbps by bitrate index, keyed by (MPEG-1, layer)
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+MPEG_SILENT_GAIN = 88  # Layer III global gain at or below which a granule is quieter than about -80 dBFS
+CUE_FILE_NAME = "cue_file.jsonl"
+PROGRESS_FILE_NAME = "processed.txt"
+POST_WORKERS = 2  # post-processing worker processes
+POST_QUEUE_DEPTH = 2  # songs queued per worker before the dispatcher waits
+POST_NICE = 10  # post-processing runs at a lower priority than the recorder
+CUE_VERSION = 1
+STDOUT_LOCK = threading.Lock()
+METRICS_PORT = None  # local port serving /metrics, off unless set
+PROFILE = False  # time and trace the memory of every post-processing stage into each block's profile file
+PROFILE_DUMP = False  # also dump a cProfile of every song next to it
+PROFILE_FILE_NAME = "profile.jsonl"
+CAPTURES = {}  # capture mode stations by name, for the local API
+CAPTURE_PORT = 8720  # local port taking /capture requests while a station is in capture mode
+METRICS_BUCKETS = (.001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)  # seconds
 
 
 class StreamData:
     """
     Structure to hold streaming data
     """
-    def __init__(self, url):
+    def __init__(self, url, station=None):
         self.xsl_url = url
+        self.station = station
         self.bitrate = None
         self.server_name = None
         self.server_type = None
@@ -64,28 +157,58 @@ class StreamData:
         self.server_description = None
         self.listeners = None
         self.title = None
+        self.failing_since = None
 
     def update(self):
-        done = False
-        start = time.time()
-        while not done:
-            try:
-                self._update()
-                done = True
-            # TODO change to accurate exception
-            # TODO change the title to represent that an error has occured (which will be fixed when updated)
-            except Exception as e:
-                if type(e) == KeyboardInterrupt:
-                    raise KeyboardInterrupt
-                if 0 < TIMEOUT < time.time() - start:
-                    raise RequestException
-                safe_stdout("\rError in updating stream, probably a dj change..")
+        while not self.poll():
+            if self.station:
+                self.station.scheduler.sleep(SONG_CHECK_INTERVAL)
+            else:
                 time.sleep(SONG_CHECK_INTERVAL)
 
+    def poll(self):
+        """
+        A single update attempt, returns whether it succeeded so the caller can schedule the retry.
+        """
+        try:
+            self._update()
+            self.failing_since = None
+            return True
+        # TODO change to accurate exception
+        # TODO change the title to represent that an error has occured (which will be fixed when updated)
+        except Exception:
+            if self.station and self.station.stop_event.is_set():
+                raise StopRecording
+            if self.failing_since is None:
+                self.failing_since = time.time()
+            if 0 < TIMEOUT < time.time() - self.failing_since:
+                self.failing_since = None
+                raise RequestException
+            if self.station:
+                self.station.stdout("\rError in updating stream, probably a dj change..")
+            else:
+                safe_stdout("\rError in updating stream, probably a dj change..")
+            return False
+
+    def from_headers(self, headers):
+        """
+        Stand in for the status page with the stream's own icy headers, returns whether they give the bitrate.
+        """
+        bitrate = headers.get("icy-br", "").split(",")[0].strip()
+        if not bitrate.isdigit():
+            return False
+        self.bitrate = int(bitrate)
+        self.server_type = headers.get("content-type", "audio/mpeg").split(";")[0].strip()
+        self.server_name = unicode(headers.get("icy-name", ""), "utf-8", "replace")
+        self.server_description = unicode(headers.get("icy-description", ""), "utf-8", "replace")
+        self.listeners = self.listeners or 0
+        self.title = "Untitled %s" % int(time.time())
+        return True
+
     def _update(self):
-        xsl = requests.get(self.xsl_url)
-        data = xsl.json()['icestats']['source'][1]
-        self.bitrate = xsl.json()['icestats']['source'][0]["bitrate"]
+        sources = HTTP.json(self.xsl_url)['icestats']['source']
+        data = sources[1]
+        self.bitrate = sources[0]["bitrate"]
         self.server_name = unicode(data["server_name"])
         self.server_type = data["server_type"]
         self.listener_peak = data['listener_peak']
@@ -93,72 +216,147 @@ class StreamData:
         self.listeners = data['listeners']
         if data.get('title'):
             self.title = unicode(data['title'])
-        elif NP_ELEMENT and backup_get_title():
-            self.title = backup_get_title()
+        elif self.station and self.station.np_element and self.station.backup_get_title():
+            self.title = self.station.backup_get_title()
         else:
             self.title = "Untitled %s" % int(time.time())
 
 
-class SongData:
-    def __init__(self, index, location, title, ext, dj, dj_ext, bitrate, duration, album, part=0, last_part=False):
-        self.index = index
+class SongData(object):
+    """
+    A song to write out of the recording. Slotted, since thousands are made for a long block, and everything
+    derived from the title is only worked out when first used.
+    """
+    __slots__ = ("song_index", "location", "raw_title", "extension", "dj", "dj_extension", "bitrate", "album",
+                 "start_position", "end_position", "part", "last_part", "_title", "_artist", "_destination_file")
+
+    def __init__(self, index, location, title, ext, dj, dj_ext, bitrate, album, start_position, end_position,
+                 part=0, last_part=False):
+        self.song_index = index
         self.location = location
         self.raw_title = title
         self.extension = ext
         self.dj = dj
         self.dj_extension = dj_ext
         self.bitrate = bitrate
-        self.duration = duration
         self.album = album
+        self.start_position = start_position
+        self.end_position = end_position
         self.part = part
         self.last_part = last_part
+        self._title = None
+        self._artist = None
+        self._destination_file = None
 
+    def _split_title(self):
         # Check if author - title splits cleanly
-        if len(self.raw_title.split('-')) == 2:
-            self.title = self.raw_title.split('-')[1]
-        else:
-            self.title = self.raw_title
-
-        if len(self.raw_title.split('-')) == 2:
-            self.artist = self.raw_title.split('-')[0]
-        elif self.dj:
-            self.artist = self.dj
+        split_title = self.raw_title.split('-')
+        if len(split_title) == 2:
+            self._artist, self._title = split_title
         else:
-            self.artist = ''
-
+            self._artist = self.dj or ''
+            self._title = self.raw_title
+
+    @property
+    def title(self):
+        if self._title is None:
+            self._split_title()
+        return self._title
+
+    @property
+    def artist(self):
+        if self._artist is None:
+            self._split_title()
+        return self._artist
+
+    @property
+    def index(self):
         #  Ensure that parts are unique to an index
-        if part == 0:
-            file_index = self.index
-        else:
-            file_index = "{}.{}".format(self.index, self.part)
-
-        cleaned_title = "".join(c for c in self.raw_title if c.isalnum() or c in KEEP_CHARACTERS).rstrip()
-
-        self.raw_segment = os.path.join(self.location, "track_%s" % self.index)
-        self.destination_file = os.path.join(self.location, "%s. %s.%s" % (
-            file_index, cleaned_title[:MAX_TITLE], self.extension))
-        self.dj_image = os.path.join(self.location, "%s.%s" % (self.dj, self.dj_extension))
-        self.file_tags = {"artist": self.artist, "title": self.title, "albumartist": self.dj,
-                          "album": os.path.dirname(self.location), "track": file_index,
-                          "comments": "Recorded with PYSS"}
-        self.index = file_index
+        if self.part == 0:
+            return self.song_index
+        return "{}.{}".format(self.song_index, self.part)
+
+    @property
+    def duration(self):
+        return stream_duration(self.start_position, self.end_position, self.bitrate)
+
+    @property
+    def destination_file(self):
+        if self._destination_file is None:
+            self._destination_file = os.path.join(self.location, "%s. %s.%s" % (
+                self.index, clean_text(self.raw_title).rstrip()[:MAX_TITLE], self.extension))
+        return self._destination_file
+
+    @property
+    def dj_image(self):
+        if self.dj_extension:
+            return os.path.join(self.location, "%s.%s" % (self.dj, self.dj_extension))
+        return None
+
+    @classmethod
+    def from_record(cls, record, block, location, start=None, end=None):
+        """
+        Build the song from a cue song record and the block record heading its cue,
+        start and end override the recorded boundaries.
+        """
+        if start is None:
+            start = record["start_position"]
+        if end is None:
+            end = record["end_position"]
+        return cls(record["index"], location, record["title"], record["extension"], block.get("dj") or "",
+                   block.get("dj_ext") or "", record["bitrate"], block["album"], start, end)
 
     def split(self):
-        duration = self.duration
+        max_bytes = int(MAX_DURATION * float(self.bitrate) * 125)
+        start = self.start_position
         parts = []
         part_index = 0
-        while duration > MAX_DURATION:
+        while self.end_position - start > max_bytes:
             parts.append(
-                SongData(self.index, self.location, self.raw_title, self.extension, self.dj, self.dj_extension,
-                         self.bitrate, MAX_DURATION, self.album, part=part_index))
-            duration -= MAX_DURATION
+                SongData(self.song_index, self.location, self.raw_title, self.extension, self.dj, self.dj_extension,
+                         self.bitrate, self.album, start, start + max_bytes, part=part_index))
+            start += max_bytes
             part_index += 1
         parts.append(
-            SongData(self.index, self.location, self.raw_title, self.extension, self.dj, self.dj_extension,
-                     self.bitrate,  duration, self.album, part=part_index, last_part=True))
+            SongData(self.song_index, self.location, self.raw_title, self.extension, self.dj, self.dj_extension,
+                     self.bitrate, self.album, start, self.end_position, part=part_index, last_part=True))
         return parts
 
 
+class CueWriter:
+    """
+    Append only cue of line delimited JSON records, flushed per record so it can be read while being written.
+    """
+    def __init__(self, cue_path):
+        self.cue_path = cue_path
+        self.lock = threading.Lock()
+        self.cue_file = open(cue_path, 'a')
+
+    def write(self, record_type, **record):
+        record["type"] = record_type
+        with self.lock:
+            self.cue_file.write(json.dumps(record) + "\n")
+            self.cue_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.cue_file.close()
+
+
+def read_cue(cue_path):
+    """
+    Yield the records of a cue one at a time, stopping at a trailing record that is still being written.
+    """
+    with open(cue_path, 'r') as cue_file:
+        for line in cue_file:
+            if not line.endswith("\n"):
+                break
+            record = json.loads(line)
+            if record["type"] == "block" and record.get("version") != CUE_VERSION:
+                raise CueFormatException("Unsupported cue version %s in %s" % (record.get("version"), cue_path))
+            yield record
+
+
 class EasyWrite:
     def __init__(self, file_location):
         self.file_location = file_location
@@ -180,42 +378,526 @@ class RequestException(Exception):
     pass
 
 
-class StreamRecorder():
-    def __init__(self, location):
+class StopRecording(Exception):
+    pass
+
+
+class CueFormatException(Exception):
+    pass
+
+
+class SegmentWriter:
+    """
+    Writes the stream into rotating track_N segments through a single open handle,
+    batching blocks in a bounded buffer so the disk only sees large writes.
+    """
+    def __init__(self, location, buffer_size=None, fsync_policy=None, cue=None):
         self.location = location
-        self.panic_lock = threading.RLock()
-
-    def _record_stream(self, request, writer_lock):
-        self.panic_lock.acquire()
-        cache_start = time.time()
-        index = 0
-        if CUE_ONLY:
-            time.sleep(1)
-            return
-        try:
-            for block in request.iter_content(chunk_size=1024):
-                if block is None:
-                    print "Recieved 0 bytes from stream."
-                    self.panic_lock.release()
-                if time.time() - MAX_DURATION > cache_start:
-                    cache_start = time.time()
-                    index += 1
-                    with open(os.path.join(self.location, "track_%s" % index), 'wb') as f:
-                        f.write(block)
+        self.cue = cue
+        self.buffer_size = buffer_size or WRITE_BUFFER_SIZE
+        self.fsync_policy = fsync_policy or FSYNC_POLICY
+        self.index = -1
+        self.handle = None
+        self.buffer = []
+        self.buffered = 0
+        self.position = 0
+        self.segment_starts = []
+        self.bytes_written = 0
+        self.open_calls = 0
+        self.write_calls = 0
+        self.fsync_calls = 0
+        # Kept here rather than in METRICS, so the write path never takes the metrics lock
+        self.write_seconds = 0.0
+        self.slowest_write = 0.0
+        self.start = None
+
+    def segment_path(self, index):
+        return os.path.join(self.location, "track_%s" % index)
+
+    def open_segment(self, index):
+        self.close()
+        self.index = index
+        # Unbuffered, every flush is exactly one write() on the handle
+        self.handle = open(self.segment_path(index), 'wb', 0)
+        self.segment_starts.append(self.position)
+        if self.cue:
+            self.cue.write("segment", index=index, position=self.position)
+        self.open_calls += 1
+        if self.start is None:
+            self.start = time.time()
+
+    def rotate(self):
+        self.open_segment(self.index + 1)
+
+    def write(self, block):
+        if self.handle is None:
+            self.open_segment(0)
+        self.buffer.append(block)
+        self.buffered += len(block)
+        self.position += len(block)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer and self.handle:
+            start = time.time()
+            self.handle.write("".join(self.buffer))
+            self.write_calls += 1
+            self.bytes_written += self.buffered
+            self.buffer = []
+            self.buffered = 0
+            if self.fsync_policy == "flush":
+                self._fsync()
+            elapsed = time.time() - start
+            self.write_seconds += elapsed
+            self.slowest_write = max(self.slowest_write, elapsed)
+
+    def _fsync(self):
+        os.fsync(self.handle.fileno())
+        self.fsync_calls += 1
+
+    def close(self):
+        if self.handle:
+            self.flush()
+            if self.fsync_policy == "segment":
+                self._fsync()
+            self.handle.close()
+            self.handle = None
+
+    def reader(self):
+        return SegmentReader(self.location, self.segment_starts)
+
+    def locate(self, position):
+        """
+        The segment index holding the stream position, and the offset into that segment.
+        """
+        if not self.segment_starts:
+            return 0, position
+        index = max(bisect.bisect_right(self.segment_starts, position) - 1, 0)
+        return index, position - self.segment_starts[index]
+
+    def stats(self):
+        elapsed = time.time() - self.start if self.start else 0
+        return {"bytes": self.bytes_written,
+                "bytes_per_second": self.bytes_written / elapsed if elapsed else 0.0,
+                "opens": self.open_calls,
+                "writes": self.write_calls,
+                "fsyncs": self.fsync_calls,
+                "write_seconds": self.write_seconds,
+                "slowest_write_seconds": self.slowest_write}
+
+
+class IcyMetadataParser:
+    """
+    Strips the metadata blocks interleaved every icy-metaint bytes out of the stream,
+    reporting each StreamTitle change along with its offset in the remaining audio.
+    """
+    def __init__(self, metaint):
+        self.metaint = metaint
+        self.audio_left = metaint
+        self.meta_left = None
+        self.meta = []
+        self.title = None
+
+    def feed(self, block):
+        audio = []
+        audio_length = 0
+        titles = []
+        i = 0
+        while i < len(block):
+            if self.meta_left is None:
+                if self.audio_left:
+                    part = block[i:i + self.audio_left]
+                    audio.append(part)
+                    audio_length += len(part)
+                    self.audio_left -= len(part)
+                    i += len(part)
                 else:
-                    with open(os.path.join(self.location, "track_%s" % index), 'ab') as f:
-                        f.write(block)
-                if writer_lock.acquire(blocking=0):
+                    # A single length byte, in units of 16 bytes, precedes every metadata block
+                    self.meta_left = ord(block[i]) * 16
+                    i += 1
+                    if not self.meta_left:
+                        self.meta_left = None
+                        self.audio_left = self.metaint
+            else:
+                part = block[i:i + self.meta_left]
+                self.meta.append(part)
+                self.meta_left -= len(part)
+                i += len(part)
+                if not self.meta_left:
+                    title = self._parse_title("".join(self.meta))
+                    self.meta = []
+                    self.meta_left = None
+                    self.audio_left = self.metaint
+                    if title is not None and title != self.title:
+                        titles.append((audio_length, title, self.title is None))
+                        self.title = title
+        return "".join(audio), titles
+
+    @staticmethod
+    def _parse_title(metadata):
+        match = ICY_TITLE_PATTERN.search(metadata.rstrip("\0"))
+        if match:
+            return match.group(1).decode('utf-8', 'replace')
+        return None
+
+
+class SegmentReader:
+    """
+    Reads byte ranges of the recorded stream back out of its track_N segments.
+    segment_starts holds the position each segment starts at, as logged in the cue,
+    which keeps positions valid once earlier segments have been removed.
+    """
+    def __init__(self, location, segment_starts=None):
+        self.location = location
+        self.segment_starts = segment_starts or None
+
+    def segment_path(self, index):
+        return os.path.join(self.location, "track_%s" % index)
+
+    def segments(self):
+        """
+        (index, start position) of every segment, worked out from the file sizes for cues without segment records.
+        """
+        if self.segment_starts is not None:
+            return list(enumerate(self.segment_starts))
+        segments = []
+        position = 0
+        while os.path.isfile(self.segment_path(len(segments))):
+            segments.append((len(segments), position))
+            position += os.path.getsize(self.segment_path(len(segments) - 1))
+        return segments
+
+    def iter_range(self, start, end):
+        """
+        Yield the bytes between two stream positions in chunks of at most COPY_CHUNK_SIZE,
+        so memory use doesn't depend on the length of the range.
+        """
+        for index, segment_start in self.segments():
+            if start >= end:
+                break
+            if not os.path.isfile(self.segment_path(index)):
+                continue
+            size = os.path.getsize(self.segment_path(index))
+            if start < segment_start + size:
+                start = max(start, segment_start)
+                stop = min(end, segment_start + size)
+                with open(self.segment_path(index), 'rb') as segment:
+                    segment.seek(start - segment_start)
+                    while start < stop:
+                        chunk = segment.read(min(COPY_CHUNK_SIZE, stop - start))
+                        if not chunk:
+                            break
+                        yield chunk
+                        start += len(chunk)
+
+    def read(self, start, end):
+        """
+        The bytes between two stream positions, only meant for small windows.
+        """
+        return "".join(self.iter_range(start, end))
+
+    def frame_boundary(self, position):
+        """
+        Move a stream position forward onto the next MPEG frame header.
+        """
+        index = find_frame(self.read(position, position + FRAME_SEARCH_WINDOW))
+        if index == -1:
+            return position
+        return position + index
+
+    def remove_segments(self, below=None):
+        """
+        Remove every segment, or only those with an index below the given one.
+        """
+        for index, segment_start in self.segments():
+            if below is not None and index >= below:
+                break
+            if os.path.isfile(self.segment_path(index)):
+                os.remove(self.segment_path(index))
+
+
+class RingBuffer:
+    """
+    The last capacity bytes of the stream in an anonymous memory map, for capture mode. Stands in for
+    SegmentWriter while recording and for SegmentReader when songs are cut out of it, positions are
+    block positions and only the last capacity bytes before position can be read.
+    """
+    def __init__(self, location, capacity):
+        self.location = location
+        self.capacity = capacity
+        self.buffer = mmap.mmap(-1, capacity)
+        self.lock = threading.Lock()
+        self.position = 0
+        self.segment_starts = [0]
+        self.start = None
+
+    def open_segment(self, index):
+        if self.start is None:
+            self.start = time.time()
+
+    def rotate(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, block):
+        with self.lock:
+            # Only the end of a block longer than the buffer is kept, but the position covers all of it
+            end = self.position + len(block)
+            block = block[-self.capacity:]
+            offset = (end - len(block)) % self.capacity
+            first = min(len(block), self.capacity - offset)
+            self.buffer[offset:offset + first] = block[:first]
+            if first < len(block):
+                self.buffer[:len(block) - first] = block[first:]
+            self.position = end
+
+    def oldest(self):
+        return max(0, self.position - self.capacity)
+
+    def reader(self):
+        return self
+
+    def locate(self, position):
+        return 0, position
+
+    def iter_range(self, start, end):
+        """
+        Yield the bytes between two positions, leaving out whatever was already overwritten.
+        """
+        while True:
+            with self.lock:
+                start = max(start, self.oldest())
+                stop = min(end, self.position)
+                if start >= stop:
                     return
-        except requests.exceptions.ChunkedEncodingError as e: # or httplib.IncompleteRead as e:
-            print e.message
-            self.panic_lock.release()
+                offset = start % self.capacity
+                chunk = self.buffer[offset:offset + min(COPY_CHUNK_SIZE, stop - start, self.capacity - offset)]
+            yield chunk
+            start += len(chunk)
+
+    def read(self, start, end):
+        return "".join(self.iter_range(start, end))
 
-    def record_stream(self, request, writer_lock):
-        writer = threading.Thread(target=self._record_stream, args=(request, writer_lock))
-        writer.daemon = True
-        writer.start()
-        return self.panic_lock, writer
+    def frame_boundary(self, position):
+        index = find_frame(self.read(position, position + FRAME_SEARCH_WINDOW))
+        if index == -1:
+            return position
+        return position + index
+
+    def stats(self):
+        elapsed = time.time() - self.start if self.start else 0
+        return {"bytes": 0, "bytes_per_second": 0.0, "opens": 0, "writes": 0, "fsyncs": 0, "write_seconds": 0.0,
+                "slowest_write_seconds": 0.0, "buffered": self.position - self.oldest(), "elapsed": elapsed}
+
+
+class StreamRecorder():
+    """
+    Records the stream for a station across its blocks, reconnecting with exponential backoff whenever
+    the connection drops so byte positions stay continuous across the gap.
+    A block ends with split() at a byte position, the audio after it is held until hand_over() gives it
+    the next block's writer, so the connection never closes between blocks.
+    """
+    def __init__(self, stream_url, cue_only=False, icy_metadata=False, station=None):
+        self.stream_url = stream_url
+        self.station = station
+        self.cue_only = cue_only
+        self.icy_metadata = icy_metadata
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.failed = threading.Event()
+        self.writer = None
+        self.cue = None
+        # Audio received between split() and hand_over(), and gaps that happened meanwhile
+        self.pending = None
+        self.pending_gaps = []
+        self.segment_time = None
+        self.titles = Queue.Queue()
+        # (position, seconds without audio) for every reconnect, for the station to report
+        self.gaps = Queue.Queue()
+        # Set when a silence starts in an MP3 stream without icy titles, to poll the status page right away
+        self.silence = threading.Event()
+        self.received = 0
+        # Never rebased, for metrics
+        self.total_received = 0
+        self.request = None
+        self.metaint = None
+        self.thread = None
+        self.first_byte = None
+        # Called from the recording thread when there are titles, gaps or a failure for the station to handle
+        self.notify = lambda: None
+
+    def _open(self):
+        headers = {"Icy-MetaData": "1"} if self.icy_metadata else {}
+        request = requests.get(self.stream_url, stream=True, headers=headers, timeout=HTTP_TIMEOUT)
+        request.raise_for_status()
+        self.request = request
+        self.metaint = int(request.headers.get("icy-metaint", 0)) or None if self.icy_metadata else None
+
+    def connect(self, stop_event):
+        """
+        Open the stream, retrying immediately once and then with exponential backoff.
+        Returns the number of attempts, or None if stop_event was set first.
+        """
+        delay = 0
+        attempts = 0
+        while True:
+            if delay:
+                stop_event.wait(delay)
+            if stop_event.is_set():
+                return None
+            attempts += 1
+            try:
+                self._open()
+                return attempts
+            except (requests.exceptions.RequestException, ValueError):
+                delay = min(max(delay * 2, RECONNECT_DELAY), RECONNECT_MAX_DELAY)
+
+    def start(self, writer, cue):
+        """
+        Record into the first block, the stream has to be connected already unless nothing needs to be read from it.
+        """
+        self.writer = writer
+        self.cue = cue
+        self.segment_time = time.time()
+        if not self.cue_only:
+            writer.open_segment(0)
+        if self.request and (self.metaint or not self.cue_only):
+            self.thread = threading.Thread(target=self._record_stream)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def buffer(self):
+        """
+        Start recording before the first block is set up, the audio is held until hand_over() like after split().
+        """
+        self.pending = []
+        self.segment_time = time.time()
+        if self.request and (self.metaint or not self.cue_only):
+            self.thread = threading.Thread(target=self._record_stream)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def split(self, position, titles=()):
+        """
+        End the current block at a byte position, titles not yet handled by the station are kept for the next block.
+        """
+        with self.lock:
+            self.writer.flush()
+            self.pending = []
+            if not self.cue_only and position < self.received:
+                self.pending.append(self.writer.reader().read(position, self.received))
+            self.writer.close()
+            self.received -= position
+            queued = list(titles)
+            while not self.titles.empty():
+                queued.append(self.titles.get())
+            for title_position, change_time, title, initial in queued:
+                self.titles.put((max(title_position - position, 0), change_time, title, initial))
+
+    def hand_over(self, writer, cue):
+        """
+        Continue recording into the next block, starting with the audio held since split().
+        """
+        with self.lock:
+            self.writer = writer
+            self.cue = cue
+            self.segment_time = time.time()
+            if not self.cue_only:
+                writer.open_segment(0)
+                for block in self.pending:
+                    writer.write(block)
+            self.pending = None
+            for gap in self.pending_gaps:
+                cue.write("gap", **gap)
+            self.pending_gaps = []
+
+    def stop(self):
+        self.stopping.set()
+        # Closing the response interrupts a read that is waiting on the server
+        if self.request:
+            self.request.close()
+        if self.thread:
+            self.thread.join()
+        if self.writer:
+            self.writer.close()
+
+    def _record_stream(self):
+        parser = IcyMetadataParser(self.metaint) if self.metaint else None
+        watcher = None if self.metaint else SilenceWatcher()
+        try:
+            while True:
+                try:
+                    for block in self.request.iter_content(chunk_size=BLOCK_SIZE):
+                        if watcher and watcher.feed(block):
+                            self.silence.set()
+                            self.notify()
+                        with self.lock:
+                            self._record_block(block, parser)
+                        if self.stopping.is_set():
+                            return
+                except requests.exceptions.RequestException:
+                    pass
+                except Exception:
+                    if self.stopping.is_set():
+                        return
+                    raise
+                # The stream dropped or ended, keep writing after the gap at the same position
+                self.request.close()
+                dropped = time.time()
+                attempts = self.connect(self.stopping)
+                if attempts is None:
+                    return
+                with self.lock:
+                    gap = {"position": self.received, "time": dropped, "gap": time.time() - dropped,
+                           "attempts": attempts}
+                    if self.pending is not None:
+                        self.pending_gaps.append(gap)
+                    elif self.cue:
+                        self.cue.write("gap", **gap)
+                    self.gaps.put((gap["position"], gap["gap"]))
+                METRICS.inc("pyss_reconnects_total", station=self.station)
+                METRICS.observe("pyss_reconnect_gap_seconds", gap["gap"], station=self.station)
+                self.notify()
+                if self.metaint:
+                    # Metadata framing restarts with the connection, a title carried over is not a new song
+                    title = parser.title if parser else None
+                    parser = IcyMetadataParser(self.metaint)
+                    parser.title = title
+                else:
+                    parser = None
+                    watcher = SilenceWatcher()
+        finally:
+            if not self.stopping.is_set():
+                self.failed.set()
+                self.notify()
+
+    def _record_block(self, block, parser):
+        if parser:
+            block, titles = parser.feed(block)
+            for offset, title, initial in titles:
+                # (position in the audio, time, title, whether it is the title the stream started with)
+                self.titles.put((self.received + offset, time.time(), title, initial))
+            if titles:
+                self.notify()
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        self.received += len(block)
+        self.total_received += len(block)
+        if self.cue_only:
+            return
+        if self.pending is not None:
+            self.pending.append(block)
+        else:
+            if time.time() - MAX_DURATION > self.segment_time:
+                self.segment_time = time.time()
+                self.writer.rotate()
+            self.writer.write(block)
 
 
 def safe_stdout(to_print):
@@ -235,6 +917,27 @@ def format_seconds(seconds):
     return "%02d:%02d" % (m, s)
 
 
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % size
+
+
+def format_writer_stats(stats):
+    return "Wrote %s at %s/s (%d opens, %d writes, %d fsyncs)" % (
+        format_bytes(stats["bytes"]), format_bytes(stats["bytes_per_second"]),
+        stats["opens"], stats["writes"], stats["fsyncs"])
+
+
+def stream_duration(start_position, end_position, bitrate):
+    """
+    Seconds of audio between two byte positions of a constant bitrate stream.
+    """
+    return (end_position - start_position) / (float(bitrate) * 125)
+
+
 def format_with_hours(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
@@ -246,294 +949,2228 @@ def wait_on_file_rename(file_name, new_name):
         os.remove(new_name)
     done = False
     start = time.time()
+    delay = .01
     while not done:
         try:
             os.rename(file_name, new_name)
             done = True
         except WindowsError or OSError as e:
-            time.sleep(.01)
+            # Back off while another process holds the file
+            time.sleep(delay)
+            delay = min(delay * 2, .5)
             if 0 < TIMEOUT < time.time() - start:
                 safe_stdout("\nTIMEOUT waiting for file access, quitting.")
                 safe_stdout(e.message)
                 raise e
 
 
-def swap_djs(location, name):
-    dj_image_url = get_dj_art()
-    response = requests.get(dj_image_url, stream=True)
-    file_name = os.path.join(location, name)
-    with open(file_name, "wb") as image:
-        for chunk in response:
-            image.write(chunk)
-    dj_image_extension = imghdr.what(file_name)
-    wait_on_file_rename(file_name, "%s.%s" % (file_name, dj_image_extension))
-    return dj_image_extension
+def mpeg_frame_length(header):
+    """
+    Length in bytes of the MPEG audio frame starting with header, 0 if it isn't a valid frame header.
+    """
+    if len(header) < 4:
+        return 0
+    b1, b2, b3 = ord(header[0]), ord(header[1]), ord(header[2])
+    if b1 != 0xFF or b2 & 0xE0 != 0xE0:
+        return 0
+    version = (b2 >> 3) & 3  # 3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5
+    layer = 4 - ((b2 >> 1) & 3)
+    bitrate_index = b3 >> 4
+    rate_index = (b3 >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return 0
+    bitrate = MPEG_BITRATES[(version == 3, layer)][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    padding = (b3 >> 1) & 1
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and version != 3:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def mpeg_frame_silent(frame):
+    """
+    Whether a Layer III frame is silent, told from its side info without decoding it: every granule either
+    spends no bits on the spectrum or has a global gain of MPEG_SILENT_GAIN or less. False for other layers.
+    """
+    b2, b4 = ord(frame[1]), ord(frame[3])
+    if (b2 >> 1) & 3 != 1:
+        return False
+    mpeg1 = (b2 >> 3) & 3 == 3
+    mono = b4 >> 6 == 3
+    channels = 1 if mono else 2
+    # Past the header, the CRC and the fields ahead of the granules, in bits
+    position = (6 if b2 & 1 == 0 else 4) * 8
+    if mpeg1:
+        position += 9 + (5 if mono else 3) + 4 * channels
+        granules, granule_bits = 2, 59
+    else:
+        position += 8 + (1 if mono else 2)
+        granules, granule_bits = 1, 63
+    side = frame[:(position + granules * channels * granule_bits + 7) // 8]
+    if len(side) * 8 < position + granules * channels * granule_bits:
+        return False
+    bits = int(binascii.hexlify(side), 16)
+    total = len(side) * 8
+    for granule in range(granules * channels):
+        start = position + granule * granule_bits
+        part2_3_length = (bits >> (total - start - 12)) & 0xFFF
+        global_gain = (bits >> (total - start - 29)) & 0xFF
+        if part2_3_length and global_gain > MPEG_SILENT_GAIN:
+            return False
+    return True
+
+
+def frame_seconds(header):
+    """
+    Seconds of audio in the MPEG frame starting with a valid header.
+    """
+    b2, b3 = ord(header[1]), ord(header[2])
+    version = (b2 >> 3) & 3
+    layer = 4 - ((b2 >> 1) & 3)
+    samples = 384 if layer == 1 else 576 if layer == 3 and version != 3 else 1152
+    return samples / float(MPEG_SAMPLE_RATES[version][(b3 >> 2) & 3])
 
 
-class SongProcessor:
-    def __init__(self, cue_path):
-        self.cue_path = cue_path
-        self.unpacker = None
-        self.file_index = 0
-        self.file_progress = 0
-        self.left_over = None
-        self.raw = None
-        self.delay = None
-
-    def _new_proc(self, song, complete):
-        sample_duration = 10 * 1000
-        remaining_duration = song.duration
-
-        # Stick files if at the end of a file
-        if (remaining_duration > self.raw.duration_seconds - self.file_progress and
-                os.path.isfile(os.path.join(song.location, "track_{}".format(self.file_index + 1)))):
-            part_a = self.raw[self.file_progress * 1000:]
-            remaining_duration -= part_a.duration_seconds
-            self.file_index += 1
-            del self.raw
-            self.raw = AudioSegment.from_file(os.path.join(song.location, "track_{}".format(self.file_index)),
-                                              song.extension)
-            if remaining_duration > self.raw.duration_seconds:
-                part_b = self.raw
-            else:
-                part_b = self.raw[:remaining_duration * 1000]
-            raw = part_a + part_b
-            self.file_progress = 0
-        else:
-            if complete:
-                raw = self.raw[self.file_progress * 1000:(self.file_progress + remaining_duration) * 1000]
+class SilenceWatcher:
+    """
+    Spots silences of at least SILENCE_CHECK in an MP3 stream as it arrives, from the side info of its frames.
+    Anything that isn't MPEG audio simply never has a silence.
+    """
+    def __init__(self):
+        # The start of a frame not complete yet
+        self.data = ""
+        self.silent = 0.0
+        self.reported = False
+
+    def feed(self, block):
+        """
+        Whether a silence reached SILENCE_CHECK in block.
+        """
+        data = self.data + block
+        offset = 0
+        found = False
+        while offset + 4 <= len(data):
+            length = mpeg_frame_length(data[offset:offset + 4])
+            if not length:
+                offset = find_frame(data, offset + 1)
+                if offset == -1:
+                    # Keep what could be the start of a header
+                    offset = len(data) - 3
+                    break
+                continue
+            if offset + length > len(data):
+                break
+            if mpeg_frame_silent(data[offset:offset + length]):
+                self.silent += frame_seconds(data[offset:offset + 4])
+                if self.silent * 1000 >= SILENCE_CHECK and not self.reported:
+                    self.reported = found = True
             else:
-                raw = self.raw[self.file_progress * 1000:]
+                self.silent = 0.0
+                self.reported = False
+            offset += length
+        self.data = data[offset:]
+        return found
 
-        self.file_progress += remaining_duration
 
-        if self.left_over and song.part == 0:
-            raw = self.left_over + raw
-            self.left_over = None
+def find_frame(data, offset=0):
+    """
+    Index of the first frame header at or after offset that is followed by another one, -1 if there is none.
+    """
+    index = data.find("\xff", offset)
+    while index != -1:
+        length = mpeg_frame_length(data[index:index + 4])
+        if length and (index + length + 4 > len(data) or
+                       mpeg_frame_length(data[index + length:index + length + 4])):
+            return index
+        index = data.find("\xff", index + 1)
+    return -1
 
-        if song.last_part and complete:
-            if not self.delay or not QUICK_PROC:
-                if raw.duration_seconds > 10:
-                    sample_range = raw[-1 * sample_duration:]
-                else:
-                    sample_range = raw
-                try:
-                    ranges = detect_silence(sample_range, min_silence_len=SILENCE_CHECK, silence_thresh=-80)
-                except TooManyMissingFrames:
-                    ranges = None
-                if ranges:
-                    self.delay = ranges[-1][1] - sample_duration
+
+def pcm_samples(segment):
+    """
+    Decoded audio as a mono float array scaled to [-1, 1].
+    """
+    import numpy
+    dtype = {1: numpy.int8, 2: numpy.int16, 4: numpy.int32}[segment.sample_width]
+    samples = numpy.frombuffer(segment.raw_data, dtype=dtype).astype(numpy.float32)
+    if segment.channels > 1:
+        samples = samples.reshape(-1, segment.channels).mean(axis=1)
+    return samples / float(2 ** (8 * segment.sample_width - 1))
+
+
+def find_silence(samples, frame_rate, boundary_ms):
+    """
+    Millisecond offset into samples where the silence closest to boundary_ms ends, on either side of it.
+    None if there is no silence at least SILENCE_CHECK long.
+    """
+    import numpy
+    frame_length = max(int(frame_rate * SILENCE_FRAME / 1000.0), 1)
+    frame_count = len(samples) // frame_length
+    if not frame_count:
+        return None
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length)
+    rms = numpy.sqrt(numpy.mean(numpy.square(frames, dtype=numpy.float64), axis=1))
+    silent = (rms <= 10 ** (SILENCE_THRESHOLD / 20.0)).astype(numpy.int8)
+    edges = numpy.diff(numpy.concatenate(([0], silent, [0])))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    ends_ms = ends[(ends - starts) * SILENCE_FRAME >= SILENCE_CHECK] * SILENCE_FRAME
+    if not len(ends_ms):
+        return None
+    return int(ends_ms[numpy.argmin(numpy.abs(ends_ms - boundary_ms))])
+
+
+def adjust_boundary(reader, position, bitrate, extension):
+    """
+    Move a song boundary onto the end of the nearest silence, decoding only the few seconds around it.
+    """
+    from pydub import AudioSegment
+    from pydub.exceptions import CouldntDecodeError
+    byte_rate = float(bitrate) * 125
+    start = max(0, position - int(SILENCE_WINDOW * byte_rate))
+    if extension == "mp3":
+        start = reader.frame_boundary(start)
+    data = reader.read(start, position + int(SILENCE_LOOKAHEAD * byte_rate))
+    try:
+        decoded = AudioSegment.from_file(BytesIO(data), extension)
+    except CouldntDecodeError:
+        return position
+    if not len(decoded):
+        return position
+    bytes_per_ms = len(data) / float(len(decoded))
+    cut = find_silence(pcm_samples(decoded), decoded.frame_rate, (position - start) / bytes_per_ms)
+    if cut is None:
+        return position
+    position = start + int(cut * bytes_per_ms)
+    if extension == "mp3":
+        position = reader.frame_boundary(position)
+    return position
+
+
+class BoundaryWorker:
+    """
+    Holds each song until the audio after its end has reached the disk, then optionally cuts it on the
+    silence around its end, logs it to the cue and hands it straight to post-processing.
+    """
+    def __init__(self, cue, location, delay, segment_starts, cut=True, post=None, reader=None, block=None):
+        self.cue = cue
+        self.reader = reader or SegmentReader(location, segment_starts)
+        # The block record and the writer's segment starts, handed on with every song so nothing rereads the cue
+        self.block = block
+        self.segment_starts = segment_starts
+        self.delay = delay
+        self.cut_songs = cut
+        self.post = post
+        self.cut = None
+        # Where the block was split for the next DJ, the song ending there keeps its end
+        self.split_position = None
+        self.songs = Queue.Queue()
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, record_type, **record):
+        self.songs.put((time.time() + self.delay, record_type, record))
+
+    def _run(self):
+        while True:
+            item = self.songs.get()
+            if item is None:
+                return
+            due, record_type, record = item
+            if due > time.time() and not self.closing.is_set():
+                # Wait for the audio after the boundary to reach the disk
+                self.closing.wait(due - time.time())
+            if self.split_position is not None and record["end_position"] >= self.split_position:
+                # The audio after the split opens the next block, cutting on silence past or before it
+                # would record bytes twice or in neither block
+                record["handover"] = True
+            if self.cut_songs:
+                record["cut_start"] = record["start_position"] if self.cut is None else self.cut
+                if record["complete"] and not record.get("handover"):
+                    record["cut_end"] = adjust_boundary(self.reader, record["end_position"], record["bitrate"],
+                                                        record["extension"])
                 else:
-                    self.delay = 0
-            if self.delay == 0:
-                post = raw
-            else:
-                post = raw[:self.delay]
-                try:
-                    self.left_over = raw[self.delay:]
-                except TooManyMissingFrames:
-                    post = raw
-                    self.left_over = None
-        else:
-            post = raw
-
-        post.export(song.destination_file, format=song.extension, bitrate="%sk" % song.bitrate)
-        audio = EasyID3()
-        audio["title"] = song.title
-        audio["artist"] = song.artist
-        audio["album"] = song.album
-        audio["albumartist"] = song.dj
-        audio["tracknumber"] = str(song.index)
-        audio["date"] = str(int(time.time()))
-        audio.save(song.destination_file)
-        if song.dj_image:
-            tags = ID3(song.destination_file)
-            with open(song.dj_image, "rb") as image:
-                tags["APIC"] = APIC(encoding=3, mime='image/%s' % song.dj_extension, type=3, desc="Cover",
-                                    data=image.read())
+                    record["cut_end"] = record["end_position"]
+                self.cut = record["cut_end"]
+            self.cue.write(record_type, **record)
+            if self.post:
+                self.post.submit_song(self.cue.cue_path, record, self.block, self.segment_starts)
+
+    def split(self, position):
+        self.split_position = position
+
+    def close(self):
+        """
+        Handle the remaining songs right away, the recorder has stopped so all their audio is on disk.
+        """
+        self.closing.set()
+        self.songs.put(None)
+        self.thread.join()
+
+
+def clean_name(name):
+    return clean_text(name).strip()
+
+
+class SongProcessor:
+    def __init__(self, cue_path, trace=False, outputs=None, duplicates=None, catalog=None):
+        self.cue_path = cue_path
+        self.reader = None
+        self.trace = trace
+        self.outputs = outputs or OUTPUT_PROFILES
+        # Profile, part, path and size of every file written, for the catalog
+        self.files = []
+        # With a catalog, the song's fingerprint and the earlier airing it repeats, if any
+        self.duplicates = duplicates
+        self.catalog = catalog
+        self.duplicate = None
+        # Seconds spent in each stage the song went through, returned to the recorder by the post-processing
+        # workers, and with trace the most memory each stage added
+        self.timings = {}
+        self.memory = {}
+
+    @contextmanager
+    def _stage(self, name):
+        start = time.time()
+        if self.trace:
+            before = traced_memory(reset=True)
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - start
+            if self.trace:
+                self.memory[name] = max(self.memory.get(name, 0), traced_memory() - before)
+
+    def _cut_positions(self, record):
+        """
+        Where the song really starts and ends, taken from the cue when it was cut live,
+        otherwise from the silence around its boundaries.
+        """
+        start = record.get("cut_start")
+        if start is None:
+            start = record["start_position"]
+            if start:
+                start = adjust_boundary(self.reader, start, record["bitrate"], record["extension"])
+        end = record.get("cut_end")
+        if end is None:
+            end = record["end_position"]
+            if record["complete"] and not record.get("handover"):
+                end = adjust_boundary(self.reader, end, record["bitrate"], record["extension"])
+        return start, end
+
+    def _copy_proc(self, song):
+        """
+        Cut the song on frame boundaries and copy its bytes as they are, nothing is re-encoded.
+        """
+        tag = self._tags(song)
+        with self._stage("copy"):
+            start = self.reader.frame_boundary(song.start_position)
+            end = self.reader.frame_boundary(song.end_position)
+            # The tag goes in first, so the file is written once and never rewritten to make room for it
+            with open(song.destination_file, 'wb') as destination:
+                destination.write(tag)
+                for chunk in self.reader.iter_range(start, end):
+                    destination.write(chunk)
+        self._written(song, "original", song.destination_file)
+
+    def _new_proc(self, song):
+        encoded = [output for output in self.outputs if output["format"] != "original"]
+        if len(encoded) < len(self.outputs):
+            self._original_proc(song)
+        if encoded:
+            self._encode_proc(song, encoded)
+
+    def _original_proc(self, song):
+        """
+        The song in the stream's own format, copied as it is when that is mp3.
+        """
+        if song.extension == "mp3":
+            return self._copy_proc(song)
+        from pydub.exceptions import CouldntEncodeError
+        # Stream the song's bytes through ffmpeg instead of decoding the whole song into memory
+        # ffmpeg writes the tags and cover art along with the audio
+        command = [converter(), "-y", "-v", "error", "-f", song.extension, "-i", "pipe:0"]
+        if song.dj_image and song.extension in COVER_ART_FORMATS:
+            command += ["-i", song.dj_image, "-map", "0:a", "-map", "1:v", "-c:v", "copy",
+                        "-disposition:v", "attached_pic"]
+        for key, value in (("title", song.title), ("artist", song.artist), ("album", song.album),
+                           ("album_artist", song.dj), ("track", song.index), ("date", int(time.time()))):
+            command += ["-metadata", (u"%s=%s" % (key, value)).encode("utf-8")]
+        command += ["-b:a", "%sk" % song.bitrate, "-f", song.extension, song.destination_file]
+        with self._stage("transcode"):
+            encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+            for chunk in self.reader.iter_range(song.start_position, song.end_position):
+                encoder.stdin.write(chunk)
+            encoder.stdin.close()
+            if encoder.wait():
+                raise CouldntEncodeError("ffmpeg exited with %s encoding %s" % (encoder.returncode,
+                                                                                song.destination_file))
+        self._written(song, "original", song.destination_file)
+
+    def _encode_proc(self, song, outputs):
+        """
+        Decode the song once and pipe the PCM to one ffmpeg encoder per output profile, the encoders run side by
+        side as their own processes so extra formats cost an encode each but never another decode.
+        """
+        from pydub.exceptions import CouldntEncodeError
+        decoder = subprocess.Popen([converter(), "-v", "error", "-f", song.extension, "-i", "pipe:0",
+                                    "-f", "wav", "pipe:1"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        encoders = {}
+        profiles = {}
+        feeder = threading.Thread(target=self._feed, args=(decoder, song))
+        feeder.daemon = True
+        try:
+            for output in outputs:
+                destination = output_file(song, output)
+                profiles[destination] = output["name"]
+                encoders[destination] = subprocess.Popen(encoder_command(song, output, destination),
+                                                         stdin=subprocess.PIPE)
+            with self._stage("encode"):
+                feeder.start()
+                failed = set()
+                for chunk in iter(lambda: decoder.stdout.read(COPY_CHUNK_SIZE), ""):
+                    for destination, encoder in encoders.items():
+                        if destination in failed:
+                            continue
+                        try:
+                            encoder.stdin.write(chunk)
+                        except IOError:
+                            # The encoder quit early, its exit code says why
+                            failed.add(destination)
+                for encoder in encoders.values():
+                    try:
+                        encoder.stdin.close()
+                    except IOError:
+                        pass
+                feeder.join()
+                errors = ["%s exited with %s" % (destination, encoder.returncode)
+                          for destination, encoder in sorted(encoders.items()) if encoder.wait()]
+                if decoder.wait():
+                    errors.append("decoder exited with %s" % decoder.returncode)
+        finally:
+            for process in [decoder] + encoders.values():
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+        if errors:
+            raise CouldntEncodeError("ffmpeg failed encoding %s: %s" % (song.destination_file, ", ".join(errors)))
+        for destination in sorted(encoders):
+            self._written(song, profiles[destination], destination)
+
+    def _written(self, song, profile, path):
+        self.files.append((profile, song.part, path, os.path.getsize(path)))
+
+    def _feed(self, decoder, song):
+        try:
+            for chunk in self.reader.iter_range(song.start_position, song.end_position):
+                decoder.stdin.write(chunk)
+        except IOError:
+            pass
+        finally:
             try:
-                tags.save()
-            except MutagenError:
-                time.sleep(1.0)
-                tags.save()
-
-    def unpack_cue(self):
-        self.delay = None
-        cue_file = open(self.cue_path, 'r')
-        dj_pack = pickle.load(cue_file)
-        if dj_pack[0]:
-            dj = dj_pack[1]
-            dj_ext = dj_pack[2]
-
-        songs = []
-        while True:
+                decoder.stdin.close()
+            except IOError:
+                pass
+
+    def _tags(self, song):
+        """
+        The song's ID3 tag with its cover art, rendered to bytes to be written ahead of the audio.
+        """
+        from mutagen.id3 import ID3, TIT2, TPE1, TALB, TPE2, TRCK, TDRC
+        with self._stage("tags"):
+            tags = ID3()
+            tags.add(TIT2(encoding=3, text=song.title))
+            tags.add(TPE1(encoding=3, text=song.artist))
+            tags.add(TALB(encoding=3, text=song.album))
+            tags.add(TPE2(encoding=3, text=song.dj))
+            tags.add(TRCK(encoding=3, text=str(song.index)))
+            tags.add(TDRC(encoding=3, text=str(int(time.time()))))
+            if song.dj_image:
+                tags.add(cover_art(song.dj_image, song.dj_extension))
+            rendered = BytesIO()
+            tags.save(rendered)
+            return rendered.getvalue()
+
+    def _process(self, record, block):
+        with self._stage("boundaries"):
+            positions = self._cut_positions(record)
+        song = SongData.from_record(record, block, self.reader.location, *positions)
+        if self.duplicates and self.catalog and self._repeats(song, record["index"]):
+            return
+        for part in song.split():
+            self._new_proc(part)
+
+    def _repeats(self, song, index):
+        """
+        Whether the song was recorded before and was taken care of by the duplicates action.
+        """
+        with self._stage("fingerprint"):
             try:
-                songs.append(pickle.load(cue_file))
-            except EOFError:
+                hashes = fingerprint(self._decode_window(song))
+                duplicate = self.catalog.claim_fingerprint(hashes, self.cue_path, index)
+            except (OSError, sqlite3.Error):
+                # Without a fingerprint the song is simply recorded again
+                return False
+        if duplicate is None:
+            return False
+        if self.duplicates == "link" and not self._link(song, duplicate["files"]):
+            # Nothing left to link to, so this airing takes over as the one kept
+            self.catalog.remove_fingerprint(duplicate["cue_path"], duplicate["index"])
+            self.catalog.add_fingerprint(self.cue_path, index, hashes)
+            return False
+        self.duplicate = dict(duplicate, action=self.duplicates)
+        return True
+
+    def _link(self, song, files):
+        """
+        Hard link the first airing's file for every output profile and part to where this airing's would go.
+        False, linking nothing, when any of them is missing.
+        """
+        links = []
+        for part in song.split():
+            for output in self.outputs:
+                profile = "original" if output["format"] == "original" else output["name"]
+                source = files.get((profile, part.part))
+                if not source or not os.path.isfile(source):
+                    return False
+                if output["format"] == "original":
+                    # Keep the first airing's extension, the station may have changed format since
+                    destination = os.path.splitext(part.destination_file)[0] + os.path.splitext(source)[1]
+                else:
+                    destination = output_file(part, output)
+                links.append((part, profile, source, destination))
+        for part, profile, source, destination in links:
+            link_or_copy(source, destination)
+            self._written(part, profile, destination)
+        return True
+
+    def _decode_window(self, song):
+        """
+        FINGERPRINT_SECONDS of the song as mono 16 bit PCM at FINGERPRINT_RATE.
+        """
+        bytes_per_second = float(song.bitrate) * 125
+        skip = max(0, min(FINGERPRINT_SKIP, song.duration - FINGERPRINT_SECONDS))
+        start = song.start_position + int(skip * bytes_per_second)
+        end = min(start + int(FINGERPRINT_SECONDS * bytes_per_second), song.end_position)
+        decoder = subprocess.Popen([converter(), "-v", "error", "-f", song.extension, "-i", "pipe:0",
+                                    "-ac", "1", "-ar", str(FINGERPRINT_RATE), "-f", "s16le", "pipe:1"],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        pcm = decoder.communicate(self.reader.read(start, end))[0]
+        if decoder.returncode:
+            raise OSError("ffmpeg exited with %s decoding %s" % (decoder.returncode, song.destination_file))
+        return pcm
+
+    def process_record(self, record, block, reader):
+        """
+        Process a song read from any reader, like a capture mode ring buffer.
+        """
+        self.reader = reader
+        self._process(record, block)
+
+    def process_song(self, record, block, segment_starts):
+        """
+        Process a song of the cue, from its record, the block record and the segment starts logged so far.
+        """
+        self.process_record(record, block, SegmentReader(os.path.dirname(self.cue_path), segment_starts))
+
+
+_COVER_ART = {}
+
+
+def cover_art(image_path, extension):
+    """
+    APIC frame for the DJ image, read once per block by each worker and reused for all of its songs.
+    """
+    from mutagen.id3 import APIC
+    key = (image_path, os.path.getmtime(image_path))
+    if key not in _COVER_ART:
+        if len(_COVER_ART) >= COVER_ART_CACHE:
+            _COVER_ART.clear()
+        with open(image_path, "rb") as image:
+            _COVER_ART[key] = APIC(encoding=3, mime='image/%s' % extension, type=3, desc="Cover", data=image.read())
+    return _COVER_ART[key]
+
+
+def progress_path(cue_path):
+    return os.path.join(os.path.dirname(cue_path), PROGRESS_FILE_NAME)
+
+
+def processed_songs(cue_path):
+    """
+    Song indexes of the block that were already processed, plus "done" once the whole block is.
+    """
+    if not os.path.isfile(progress_path(cue_path)):
+        return set()
+    with open(progress_path(cue_path)) as progress:
+        return set(line.strip() for line in progress if line.endswith("\n"))
+
+
+def mark_processed(cue_path, entry):
+    with open(progress_path(cue_path), 'a') as progress:
+        progress.write("%s\n" % entry)
+
+
+def _post_worker_init():
+    # Ctrl-C is handled by the recorder, which then waits on the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(os, "nice"):
+        os.nice(POST_NICE)
+    # Import what songs need while the pool waits on its first one, not in the recorder's process
+    try:
+        import pydub
+        import mutagen.id3
+    except ImportError:
+        pass
+
+
+def clean_text(text):
+    return UNSAFE_CHARACTERS.sub("", text)
+
+
+def converter():
+    """
+    The ffmpeg pydub found.
+    """
+    from pydub import AudioSegment
+    return AudioSegment.converter
+
+
+def memory_high_water():
+    """
+    Peak resident memory of this process in bytes, None where it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def traced_memory(reset=False):
+    """
+    Memory in bytes for profiling the stages, the peak of traced allocations when tracemalloc is tracing,
+    otherwise the resident high water mark. reset starts a new peak where tracemalloc can.
+    """
+    if tracemalloc and tracemalloc.is_tracing():
+        if reset and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+            return tracemalloc.get_traced_memory()[0]
+        return tracemalloc.get_traced_memory()[1]
+    return memory_high_water() or 0
+
+
+def fingerprint(pcm):
+    """
+    Landmark hashes of mono 16 bit PCM as (hash, frame) pairs. The loudest frequency in every band of every
+    frame is a peak, and each peak is hashed with the next few peaks as both frequencies and the frames between
+    them, so two airings share hashes at a constant frame offset whatever their boundaries were.
+    """
+    import numpy
+    samples = numpy.frombuffer(pcm, dtype="<i2").astype(numpy.float32)
+    hop = FINGERPRINT_FRAME // 2
+    if len(samples) < FINGERPRINT_FRAME:
+        return []
+    count = (len(samples) - FINGERPRINT_FRAME) // hop + 1
+    frames = numpy.lib.stride_tricks.as_strided(samples, (count, FINGERPRINT_FRAME),
+                                                (samples.strides[0] * hop, samples.strides[0]))
+    spectrum = numpy.log1p(numpy.abs(numpy.fft.rfft(frames * numpy.hanning(FINGERPRINT_FRAME), axis=1)))
+    peaks = []
+    for low, high in zip(FINGERPRINT_BANDS, FINGERPRINT_BANDS[1:]):
+        band = spectrum[:, low:high]
+        loudest = band.argmax(axis=1)
+        level = band.max(axis=1)
+        # Only peaks louder than the frames around them and the rest of the song, held notes and quiet bands
+        # would otherwise hash the same thing over and over
+        padded = numpy.pad(level, FINGERPRINT_NEIGHBOURS, "constant")
+        around = numpy.max([padded[shift:shift + len(level)] for shift in range(2 * FINGERPRINT_NEIGHBOURS + 1)],
+                           axis=0)
+        for frame in numpy.nonzero((level >= around) & (level > numpy.median(level)))[0]:
+            peaks.append((int(frame), low + int(loudest[frame])))
+    peaks.sort()
+    hashes = []
+    for i, (frame, frequency) in enumerate(peaks):
+        paired = 0
+        for later, other in peaks[i + 1:]:
+            delta = later - frame
+            if delta > FINGERPRINT_ZONE:
                 break
-        cue_file.close()
-        self.raw = AudioSegment.from_file(
-            os.path.join(songs[0][0].location, "track_0"), songs[0][0].extension)
-        for song in songs:
-            for part in song[0].split():
-                self._new_proc(part, song[1])
-        for track in range(0, self.file_index+1):
-            os.remove(os.path.join(songs[0][0].location, "track_{}".format(track)))
-
-    def threaded_unpack(self):
-        self.unpacker = threading.Thread(target=self.unpack_cue)
-        self.unpacker.start()
-
-    def mp_unpack(self):
-        self.unpacker = multiprocessing.Process(target=self.unpack_cue)
-        self.unpacker.start()
+            if delta:
+                hashes.append(((frequency << 16) | (other << 6) | delta, frame))
+                paired += 1
+                if paired == FINGERPRINT_FAN_OUT:
+                    break
+    return hashes
+
+
+def parse_output(output):
+    """
+    An output profile from the config, either a dict or "format[:bitrate]" like opus:96k.
+    """
+    if not isinstance(output, dict):
+        output = dict(zip(("format", "bitrate"), output.split(":", 1)))
+    output = dict(output)
+    if output.get("format") != "original" and output.get("format") not in OUTPUT_ENCODERS:
+        raise ValueError("Unknown output format %s, expected original or one of %s" % (
+            output.get("format"), ", ".join(sorted(OUTPUT_ENCODERS))))
+    output.setdefault("name", output["format"] + output.get("bitrate", ""))
+    return output
+
+
+def output_file(song, output):
+    """
+    Where a song is written for an encoded output profile, in a folder named after the profile.
+    """
+    folder = os.path.join(song.location, output["name"])
+    try:
+        os.mkdir(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+    name = os.path.splitext(os.path.basename(song.destination_file))[0]
+    return os.path.join(folder, "%s.%s" % (name, OUTPUT_ENCODERS[output["format"]][1]))
+
+
+def encoder_command(song, output, destination):
+    codec, extension, muxer = OUTPUT_ENCODERS[output["format"]]
+    command = [converter(), "-y", "-v", "error", "-f", "wav", "-i", "pipe:0"]
+    if song.dj_image and extension in COVER_ART_FORMATS + ("mp3",):
+        command += ["-i", song.dj_image, "-map", "0:a", "-map", "1:v", "-c:v", "copy",
+                    "-disposition:v", "attached_pic"]
+    for key, value in (("title", song.title), ("artist", song.artist), ("album", song.album),
+                       ("album_artist", song.dj), ("track", song.index), ("date", int(time.time()))):
+        command += ["-metadata", (u"%s=%s" % (key, value)).encode("utf-8")]
+    command += ["-c:a", codec]
+    if output.get("bitrate"):
+        command += ["-b:a", output["bitrate"]]
+    return command + ["-f", muxer, destination]
+
+
+def process_song(cue_path, record, block, segment_starts, profile=False, dump=False, outputs=None, duplicates=None,
+                 catalog_path=None):
+    """
+    Pool job processing one song, errors are returned since the result callback is the only way back.
+    Returns the cue, song index, error and the worker's stats.
+    """
+    index = record["index"]
+    if profile and tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    catalog = Catalog(catalog_path) if duplicates and catalog_path else None
+    processor = SongProcessor(cue_path, trace=profile, outputs=outputs, duplicates=duplicates, catalog=catalog)
+    profiler = cProfile.Profile() if dump else None
+    try:
+        if profiler:
+            profiler.enable()
+        processor.process_song(record, block, segment_starts)
+        error = None
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    finally:
+        if profiler:
+            profiler.disable()
+            # pstats format, readable by pstats, snakeviz or flameprof
+            profiler.dump_stats(os.path.join(os.path.dirname(cue_path), "profile_%s.prof" % index))
+    stats = {"memory_high_water": memory_high_water(), "timings": processor.timings, "files": processor.files,
+             "duplicate": processor.duplicate}
+    if profile:
+        stats["memory"] = processor.memory
+        stats["memory_source"] = "tracemalloc" if tracemalloc and tracemalloc.is_tracing() else "high_water"
+    return cue_path, index, error, stats
+
+
+def write_duplicate(cue_path, index, duplicate):
+    """
+    Log a song that wasn't recorded again next to its cue, pointing at the airing it repeats.
+    """
+    with open(os.path.join(os.path.dirname(cue_path), DUPLICATES_FILE_NAME), 'a') as duplicates:
+        duplicates.write(json.dumps({"index": index, "cue_path": duplicate["cue_path"], "song": duplicate["index"],
+                                     "title": duplicate["title"], "file_path": duplicate["file_path"]}) + "\n")
+
+
+def write_profile(cue_path, record_type, **record):
+    record["type"] = record_type
+    with open(os.path.join(os.path.dirname(cue_path), PROFILE_FILE_NAME), 'a') as profile:
+        profile.write(json.dumps(record) + "\n")
+
+
+class PostProcessor:
+    """
+    Persistent pool of low priority workers fed one song at a time, each song is queued as soon as it is logged.
+    Progress is written next to every cue, so blocks left unfinished by a crash are resumed on startup,
+    and segments are removed as soon as no unprocessed song needs them.
+    """
+    def __init__(self, workers=None, catalog=None):
+        self.workers = workers or POST_WORKERS
+        self.catalog = catalog
+        self.pool = multiprocessing.Pool(self.workers, _post_worker_init)
+        self.slots = threading.Semaphore(self.workers * POST_QUEUE_DEPTH)
+        self.jobs = Queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.blocks = {}
+        # Folders still to be scanned for unfinished blocks
+        self.scans = 0
+        self.memory_high_water = None
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        METRICS.register(self._metrics)
+
+    def _metrics(self):
+        return [("pyss_post_queue_depth", "gauge", {}, self.queue_depth()),
+                ("pyss_post_worker_memory_high_water_bytes", "gauge", {}, self.memory_high_water or 0)]
+
+    def _block(self, cue_path):
+        if cue_path not in self.blocks:
+            # pending maps song indexes to the first segment they need, floor is the first segment
+            # the songs not logged yet can need. record and segment_starts are the block record and where each
+            # segment starts, kept up to date by the recorder so songs are processed without rereading the cue
+            self.blocks[cue_path] = {"submitted": set(), "pending": {}, "floor": 0, "removed": 0,
+                                     "ended": False, "failed": False, "profile": {}, "record": None,
+                                     "segment_starts": []}
+        return self.blocks[cue_path]
+
+    def submit_song(self, cue_path, record, block_record, segment_starts):
+        with self.lock:
+            block = self._block(cue_path)
+            block["record"] = block_record
+            block["segment_starts"] = segment_starts
+            if record["index"] in block["submitted"]:
+                return
+            block["submitted"].add(record["index"])
+            block["pending"][record["index"]] = block["floor"] = record.get("first_segment", record["start"][0])
+        self.jobs.put(("song", cue_path, record))
+
+    def submit_cue(self, cue_path):
+        """
+        Queue the songs of a finished block that weren't submitted yet, the block is wrapped up once they are done.
+        """
+        with self.lock:
+            self._block(cue_path)
+        self.jobs.put(("cue", cue_path, None))
+
+    def resume(self, file_path):
+        """
+        Queue every block under file_path that wasn't completely processed. The folder is scanned by the
+        dispatcher, so stations start recording without waiting on the archive.
+        """
+        with self.lock:
+            self.scans += 1
+        self.jobs.put(("resume", file_path, None))
+
+    def _resume(self, file_path):
+        count = 0
+        try:
+            names = sorted(os.listdir(file_path)) if os.path.isdir(file_path) else []
+        except OSError as e:
+            safe_stdout("\rCouldn't look for unfinished blocks in %s, %s\n" % (file_path, e))
+            names = []
+        for name in names:
+            cue_path = os.path.join(file_path, name, CUE_FILE_NAME)
+            try:
+                # Capture mode blocks were never written to disk past their cue
+                if (os.path.isfile(cue_path) and not next(read_cue(cue_path), {}).get("capture") and
+                        "done" not in processed_songs(cue_path)):
+                    self.submit_cue(cue_path)
+                    count += 1
+            except (IOError, ValueError, KeyError, CueFormatException) as e:
+                safe_stdout("\rSkipping unreadable block %s, %s" % (name, e))
+                safe_stdout("\n")
+        if count:
+            safe_stdout("\rResuming post-processing of %d unfinished blocks\n" % count)
+        with self.lock:
+            self.scans -= 1
+            self.idle.notify_all()
+
+    def queue_depth(self):
+        with self.lock:
+            return sum(len(block["pending"]) for block in self.blocks.values())
+
+    def _dispatch(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            action, cue_path, record = job
+            if action == "resume":
+                self._resume(cue_path)
+            elif action == "cue":
+                # A single pass over the cue, the songs are only sent to the pool once it is read through
+                segment_starts = []
+                failed = False
+                try:
+                    done = processed_songs(cue_path)
+                    block_record = None
+                    for record in read_cue(cue_path):
+                        if record["type"] == "block":
+                            block_record = record
+                        elif record["type"] == "segment":
+                            segment_starts.append(record["position"])
+                        elif record["type"] == "song" and str(record["index"]) not in done:
+                            self.submit_song(cue_path, record, block_record, segment_starts)
+                except (IOError, ValueError, KeyError, CueFormatException) as e:
+                    # The block keeps its segments, the songs read so far are still processed
+                    safe_stdout("\rCouldn't read the cue of %s, %s" % (os.path.basename(os.path.dirname(cue_path)), e))
+                    safe_stdout("\n")
+                    failed = True
+                with self.lock:
+                    block = self.blocks[cue_path]
+                    block["segment_starts"] = segment_starts
+                    block["failed"] = block["failed"] or failed
+                    block["ended"] = True
+                    self._check_block(cue_path)
+            else:
+                # Backpressure, only a bounded number of songs wait on the pool at any time
+                self.slots.acquire()
+                catalog_path = self.catalog.path if self.catalog else None
+                with self.lock:
+                    block = self.blocks[cue_path]
+                    block_record, segment_starts = block["record"], list(block["segment_starts"])
+                self.pool.apply_async(process_song, (cue_path, record, block_record, segment_starts, PROFILE,
+                                                     PROFILE_DUMP, OUTPUT_PROFILES, DUPLICATES, catalog_path),
+                                      callback=self._song_done)
+
+    def _song_done(self, result):
+        cue_path, index, error, stats = result
+        self.slots.release()
+        for stage, seconds in stats["timings"].items():
+            METRICS.observe("pyss_post_stage_seconds", seconds, stage=stage)
+        METRICS.inc("pyss_songs_processed_total", result="failed" if error else "ok")
+        with self.lock:
+            self.memory_high_water = max(self.memory_high_water, stats["memory_high_water"])
+            block = self.blocks[cue_path]
+            del block["pending"][index]
+            if PROFILE:
+                write_profile(cue_path, "song", index=index, seconds=stats["timings"], memory=stats["memory"],
+                              memory_source=stats["memory_source"], error=error)
+                for stage, seconds in stats["timings"].items():
+                    block["profile"][stage] = block["profile"].get(stage, 0.0) + seconds
+            if error:
+                block["failed"] = True
+                safe_stdout("\nFailed to process song %s of %s, %s\n" % (index, os.path.dirname(cue_path), error))
+            else:
+                mark_processed(cue_path, index)
+            self._check_block(cue_path)
+        if self.catalog and stats["files"]:
+            self.catalog.queue("add_files", cue_path, index, stats["files"])
+        duplicate = stats["duplicate"]
+        if duplicate:
+            METRICS.inc("pyss_duplicates_total", action=duplicate["action"])
+            if duplicate["action"] == "cue":
+                write_duplicate(cue_path, index, duplicate)
+            if self.catalog:
+                self.catalog.queue("add_duplicate", cue_path, index, duplicate)
+        elif self.catalog and error:
+            # The worker stored the fingerprint as a first airing, repeats can't be matched against a failed song
+            self.catalog.queue("remove_fingerprint", cue_path, index)
+
+    def _check_block(self, cue_path):
+        block = self.blocks[cue_path]
+        if block["ended"] and not block["pending"]:
+            del self.blocks[cue_path]
+            if PROFILE and block["profile"]:
+                write_profile(cue_path, "summary", songs=len(block["submitted"]), seconds=block["profile"])
+                # The slowest stages, the rest is in the block's profile file
+                safe_stdout("\nProfiled %d songs: %s\n" % (len(block["submitted"]), ", ".join(
+                    "%s %.2fs" % stage for stage in sorted(block["profile"].items(), key=lambda item: -item[1])[:3])))
+            # Failed songs keep their segments so they are retried on the next start
+            if not block["failed"]:
+                SegmentReader(os.path.dirname(cue_path), block["segment_starts"]).remove_segments()
+                mark_processed(cue_path, "done")
+            self.idle.notify_all()
+        elif not block["failed"]:
+            needed = min(block["pending"].values() + ([] if block["ended"] else [block["floor"]]))
+            if needed > block["removed"]:
+                SegmentReader(os.path.dirname(cue_path), block["segment_starts"]).remove_segments(below=needed)
+                block["removed"] = needed
 
     def join(self):
-        if self.unpacker:
-            self.unpacker.join()
+        """
+        Wait for every queued block to be processed, then shut the pool down and finish the catalog writes.
+        """
+        with self.lock:
+            while self.blocks or self.scans:
+                self.idle.wait(1.0)
+        self.jobs.put(None)
+        self.dispatcher.join()
+        self.pool.close()
+        self.pool.join()
+        if self.catalog:
+            self.catalog.join()
+        if self.memory_high_water:
+            safe_stdout("Post-processing peak memory per worker: %s\n" % format_bytes(self.memory_high_water))
+
+
+class HttpClient:
+    """
+    Keep-alive session shared by every status, DJ page and art request of the process.
+    Responses are revalidated with ETag / Last-Modified, and parsed pages are reused for PAGE_TTL seconds.
+    """
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_HOSTS, pool_maxsize=HTTP_CONNECTIONS_PER_HOST)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.validated = {}
+        self.pages = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.failures = 0
+
+    def get(self, url):
+        """
+        Returns the body of url and whether it changed since the last time it was fetched.
+        """
+        headers = {}
+        with self.lock:
+            cached = self.validated.get(url)
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        try:
+            response = self.session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            with self.lock:
+                self.requests += 1
+                self.failures += 1
+            raise
+        with self.lock:
+            self.requests += 1
+            if response.status_code == 304:
+                self.not_modified += 1
+        if response.status_code == 304 and cached:
+            return cached["content"], False
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        with self.lock:
+            if etag or last_modified:
+                self.validated[url] = {"etag": etag, "last_modified": last_modified, "content": response.content}
+            else:
+                self.validated.pop(url, None)
+        return response.content, True
+
+    def json(self, url):
+        return json.loads(self.get(url)[0])
+
+    def page(self, url):
+        """
+        The parsed page at url, only fetched again once PAGE_TTL has passed and only parsed again if it changed.
+        """
+        from pyquery import PyQuery
+        with self.lock:
+            cached = self.pages.get(url)
+        if cached and time.time() - cached[0] < PAGE_TTL:
+            return cached[1]
+        content, changed = self.get(url)
+        query = PyQuery(content) if changed or not cached else cached[1]
+        with self.lock:
+            self.pages[url] = (time.time(), query)
+        return query
+
+
+HTTP = HttpClient()
 
 
-def begin_recording(stream_data, stream_url):
+class Metrics:
     """
-    Returns first whether to continue recording, and secondly if the recording is incomplete.
+    Counters and histograms of the whole process, rendered in the Prometheus text format.
+    Values that already exist elsewhere are read by registered collectors on every scrape instead.
     """
-    song_index = 1
-    dj = ""
-    dj_ext = ""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Off until metrics are served, nothing is counted for nobody to read
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, value) for key, value in labels.items() if value is not None))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
 
-    try:
-        if CHECK_FOR_DJ:
-            dj_found = False
-            while not dj_found:
-                new_dj = get_dj()
-                if new_dj != dj:
-                    if new_dj in EXCLUDE_DJ:
-                        safe_stdout("\rExcluded DJ detected, skipping %s" % new_dj)
-                        time.sleep(DJ_CHECK_INTERVAL)
-                        continue
-                    dj = new_dj
-                    dj_found = True
-    except KeyboardInterrupt:
-        safe_stdout("\nQuitting program..")
-        return False, None
-
-    folder_name = album = str(int(time.time()))
-    if dj:
-        folder_name += " %s" % dj
-    location = os.path.join(FILE_PATH, folder_name)
-    os.mkdir(location)
-    cue_path = os.path.join(location, "cue_file.txt")
-    cue_file = open(cue_path, 'w+')
-
-    if CHECK_FOR_DJ:
-        dj_ext = swap_djs(location, dj)
-        safe_stdout(WHITE_SPACE)
-        to_write = [True, dj, dj_ext]
-        safe_stdout("\rDJ %s has taken over the stream." % dj)
-        safe_stdout("\n")
-        pickle.dump(to_write, cue_file)
-    else:
-        to_write = [False]
-        pickle.dump(to_write, cue_file)
-
-    writer_lock = threading.RLock()
-    writer_lock.acquire()
-    writer = StreamRecorder(location)
-    request = requests.get(stream_url, stream=True)
-    panic_lock, writer_thread = writer.record_stream(request, writer_lock)
-    current_title = stream_data.title
-    song_start = time.time()
-    recording_start = song_start
-    bitrate = stream_data.bitrate
-    audio_extension = SERVER_TYPES.get(stream_data.server_type,
-                                       stream_data.server_type)
-    safe_stdout("%.3d. %s %s" % (song_index, stream_data.title,
-                                 format_with_hours(time.time() - recording_start)))
-    safe_stdout("\n")
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                # per bucket counts, count, sum
+                self.histograms[key] = [[0] * len(METRICS_BUCKETS), 0, 0.0]
+            histogram = self.histograms[key]
+            bucket = bisect.bisect_left(METRICS_BUCKETS, value)
+            if bucket < len(METRICS_BUCKETS):
+                histogram[0][bucket] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def register(self, collector):
+        """
+        collector() returns a list of (name, type, labels, value) samples.
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def unregister(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (key, unicode(value).replace("\\", "\\\\").replace('"', '\\"')
+                                               .replace("\n", "\\n"))
+                                 for key, value in labels)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), count, total))
+                                for key, (buckets, count, total) in self.histograms.items())
+            collectors = list(self.collectors)
+        samples = {}
+        for collector in collectors:
+            for name, kind, labels, value in collector():
+                samples.setdefault((name, kind), []).append((self._key(name, labels)[1], value))
+        for (name, labels), value in counters:
+            samples.setdefault((name, "counter"), []).append((labels, value))
+        lines = []
+        for (name, kind), values in sorted(samples.items()):
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in values:
+                lines.append("%s%s %s" % (name, self._labels(labels), value))
+        last = None
+        for (name, labels), (buckets, count, total) in histograms:
+            if name != last:
+                lines.append("# TYPE %s histogram" % name)
+                last = name
+            cumulative = 0
+            for bound, bucket in zip(METRICS_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append("%s_bucket%s %d" % (name, self._labels(labels + (("le", bound),)), cumulative))
+            lines.append("%s_bucket%s %d" % (name, self._labels(labels + (("le", "+Inf"),)), count))
+            lines.append("%s_sum%s %s" % (name, self._labels(labels), total))
+            lines.append("%s_count%s %d" % (name, self._labels(labels), count))
+        return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+METRICS = Metrics()
+METRICS.register(lambda: [("pyss_http_requests_total", "counter", {}, HTTP.requests),
+                          ("pyss_http_not_modified_total", "counter", {}, HTTP.not_modified),
+                          ("pyss_http_failures_total", "counter", {}, HTTP.failures),
+                          ("pyss_memory_high_water_bytes", "gauge", {}, memory_high_water() or 0)])
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /metrics for scrapers, and POST /capture?station=name&index=n to write a song out of a capture mode
+    station's ring buffer, the one on air when index is left out.
+    """
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/metrics" and METRICS.enabled:
+            self._send(METRICS.render(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/capture":
+            # Writes a song out, so a stray GET from a browser or crawler doesn't
+            self.send_error(405, "Use POST")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/capture":
+            # The station and index can come in the query string or as a form
+            length = int(self.headers.getheader("Content-Length") or 0)
+            query = urlparse.parse_qs(url.query)
+            query.update(urlparse.parse_qs(self.rfile.read(length) if length else ""))
+            name = query.get("station", [None])[0]
+            if name is None and len(CAPTURES) == 1:
+                name = CAPTURES.keys()[0]
+            if name not in CAPTURES:
+                self.send_error(404, "No capture mode station %s" % name)
+                return
+            try:
+                index = int(query["index"][0]) if "index" in query else None
+            except ValueError:
+                self.send_error(400, "index has to be a number")
+                return
+            self._send(json.dumps(CAPTURES[name].capture_song(index)), "application/json")
+        else:
+            self.send_error(404)
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the status lines clean
+        pass
 
+
+def serve_metrics(port):
+    """
+    Serve METRICS and the capture API on localhost from a background thread.
+    """
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def link_or_copy(source, destination):
+    if os.path.isfile(destination):
+        os.remove(destination)
+    if hasattr(os, "link"):
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+
+class ArtCache:
+    """
+    DJ art stored on disk once per content hash. Art is revalidated with the stored ETag / Last-Modified
+    at most every ART_REVALIDATE seconds, and the least recently used art goes once over ART_CACHE_SIZE.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, "index.json")
+        self.lock = threading.Lock()
+        self.index = {"djs": {}, "files": {}}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index:
+                self.index = json.load(index)
+
+    def fetch(self, dj, url):
+        """
+        Path and extension of the DJ's art, downloading it only if it is new or changed.
+        """
+        headers = {}
+        with self.lock:
+            entry = self.index["djs"].get(dj)
+            if entry and (entry["url"] != url or not os.path.isfile(os.path.join(self.path, entry["file"]))):
+                entry = None
+            if entry:
+                if time.time() - entry["checked"] < ART_REVALIDATE:
+                    return self._use(entry)
+                if entry["etag"]:
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    headers["If-Modified-Since"] = entry["last_modified"]
+        response = HTTP.session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        with self.lock:
+            if response.status_code == 304 and entry:
+                entry["checked"] = time.time()
+                return self._use(entry)
+            response.raise_for_status()
+            extension = imghdr.what(None, h=response.content)
+            file_name = "%s.%s" % (hashlib.sha1(response.content).hexdigest(), extension)
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            if not os.path.isfile(os.path.join(self.path, file_name)):
+                with open(os.path.join(self.path, file_name), "wb") as image:
+                    image.write(response.content)
+            entry = {"url": url, "file": file_name, "extension": extension, "checked": time.time(),
+                     "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+            self.index["djs"][dj] = entry
+            result = self._use(entry)
+            self._trim(file_name)
+            return result
+
+    def _use(self, entry):
+        self.index["files"][entry["file"]] = time.time()
+        self._save()
+        return os.path.join(self.path, entry["file"]), entry["extension"]
+
+    def _trim(self, keep):
+        files = sorted(self.index["files"].items(), key=lambda item: item[1])
+        sizes = dict((name, os.path.getsize(os.path.join(self.path, name)))
+                     for name, used in files if os.path.isfile(os.path.join(self.path, name)))
+        total = sum(sizes.values())
+        for name, used in files:
+            if total <= ART_CACHE_SIZE:
+                break
+            if name == keep:
+                continue
+            if name in sizes:
+                os.remove(os.path.join(self.path, name))
+                total -= sizes[name]
+            del self.index["files"][name]
+            for dj in [dj for dj, entry in self.index["djs"].items() if entry["file"] == name]:
+                del self.index["djs"][dj]
+        self._save()
+
+    def _save(self):
+        temporary = self.index_path + ".tmp"
+        with open(temporary, "w") as index:
+            json.dump(self.index, index)
+        wait_on_file_rename(temporary, self.index_path)
+
+
+class Catalog:
+    """
+    SQLite index of every song logged under the file_path, with full text search over titles, artists, DJs and
+    stations. Songs are added as they are logged and get their files once post-processed. Connections are opened
+    per thread on first use, so the catalog can be made before the post-processing workers fork. Writes from the
+    station threads and the post-processing dispatcher go through queue and are made in order on a writer thread,
+    so a worker holding the database doesn't stall them.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS songs (
+            id INTEGER PRIMARY KEY, cue_path TEXT NOT NULL, song_index INTEGER NOT NULL, station TEXT, dj TEXT,
+            title TEXT, artist TEXT, air_time REAL, duration REAL, file_path TEXT, bytes INTEGER,
+            UNIQUE (cue_path, song_index));
+        CREATE INDEX IF NOT EXISTS songs_air_time ON songs (air_time);
+        CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts4(content="songs", title, artist, dj, station);
+        CREATE TRIGGER IF NOT EXISTS songs_ai AFTER INSERT ON songs BEGIN
+            INSERT INTO songs_fts (docid, title, artist, dj, station)
+            VALUES (new.id, new.title, new.artist, new.dj, new.station);
+        END;
+        CREATE TRIGGER IF NOT EXISTS songs_bu BEFORE UPDATE OF title, artist, dj, station ON songs BEGIN
+            DELETE FROM songs_fts WHERE docid = old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS songs_au AFTER UPDATE OF title, artist, dj, station ON songs BEGIN
+            INSERT INTO songs_fts (docid, title, artist, dj, station)
+            VALUES (new.id, new.title, new.artist, new.dj, new.station);
+        END;
+        CREATE TRIGGER IF NOT EXISTS songs_bd BEFORE DELETE ON songs BEGIN
+            DELETE FROM songs_fts WHERE docid = old.id;
+        END;
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            hash INTEGER NOT NULL, song_id INTEGER NOT NULL, frame INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (hash);
+        CREATE TABLE IF NOT EXISTS duplicates (song_id INTEGER PRIMARY KEY, original_id INTEGER NOT NULL, action TEXT);
+        CREATE TABLE IF NOT EXISTS files (
+            song_id INTEGER NOT NULL, profile TEXT NOT NULL, part INTEGER NOT NULL, path TEXT NOT NULL, bytes INTEGER,
+            PRIMARY KEY (song_id, profile, part));
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = Queue.Queue()
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def queue(self, method, *args):
+        """
+        Call the named write method with args on the writer thread, started on first use.
+        """
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run_writes)
+                self.writer.daemon = True
+                self.writer.start()
+        self.writes.put((method, args))
+
+    def _run_writes(self):
+        while True:
+            method, args = self.writes.get()
+            try:
+                getattr(self, method)(*args)
+            except Exception as e:
+                safe_stdout("\rCouldn't update the catalog, %s" % e)
+                safe_stdout("\n")
+            finally:
+                self.writes.task_done()
+
+    def join(self):
+        """
+        Wait for the queued writes.
+        """
+        if self.writer is not None:
+            self.writes.join()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            connection = self.local.connection = sqlite3.connect(self.path, timeout=CATALOG_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(self.SCHEMA)
+        return connection
+
+    def _write(self, statements):
+        try:
+            with self._connection() as connection:
+                for statement in statements:
+                    cursor = connection.execute(*statement)
+                    if cursor.rowcount:
+                        return
+        except sqlite3.Error as e:
+            safe_stdout("\rCouldn't update the catalog, %s\n" % e)
+
+    def add_song(self, cue_path, index, station, song, air_time):
+        """
+        Add or update a logged song, song is its SongData.
+        """
+        values = (station, song.dj, song.title.strip(), song.artist.strip(), air_time, song.duration)
+        self._write([
+            ("UPDATE songs SET station = ?, dj = ?, title = ?, artist = ?, air_time = ?, duration = ? "
+             "WHERE cue_path = ? AND song_index = ?", values + (cue_path, index)),
+            ("INSERT INTO songs (station, dj, title, artist, air_time, duration, cue_path, song_index) "
+             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values + (cue_path, index))])
+
+    def add_files(self, cue_path, index, files):
+        """
+        Record every file a song was written to as (profile, part, path, bytes), the song itself shows the first
+        one and the bytes of them all.
+        """
+        try:
+            with self._connection() as connection:
+                song = connection.execute("SELECT id FROM songs WHERE cue_path = ? AND song_index = ?",
+                                          (cue_path, index)).fetchone()
+                if song:
+                    connection.execute("UPDATE songs SET file_path = ?, bytes = ? WHERE id = ?",
+                                       (files[0][2], sum(entry[3] for entry in files), song[0]))
+                    connection.execute("DELETE FROM files WHERE song_id = ?", song)
+                    connection.executemany("INSERT INTO files (song_id, profile, part, path, bytes) "
+                                           "VALUES (?, ?, ?, ?, ?)", [song + entry for entry in files])
+        except sqlite3.Error as e:
+            safe_stdout("\rCouldn't update the catalog, %s\n" % e)
+
+    def add_fingerprint(self, cue_path, index, hashes):
+        try:
+            with self._connection() as connection:
+                self._store_fingerprint(connection, cue_path, index, hashes)
+        except sqlite3.Error as e:
+            safe_stdout("\rCouldn't update the catalog, %s\n" % e)
+
+    def _store_fingerprint(self, connection, cue_path, index, hashes):
+        song = connection.execute("SELECT id FROM songs WHERE cue_path = ? AND song_index = ?",
+                                  (cue_path, index)).fetchone()
+        if song:
+            connection.execute("DELETE FROM fingerprints WHERE song_id = ?", song)
+            connection.executemany("INSERT INTO fingerprints (hash, song_id, frame) VALUES (?, ?, ?)",
+                                   [(value, song[0], frame) for value, frame in hashes])
+
+    def remove_fingerprint(self, cue_path, index):
+        self._write([("DELETE FROM fingerprints WHERE song_id IN "
+                      "(SELECT id FROM songs WHERE cue_path = ? AND song_index = ?)", (cue_path, index))])
+
+    def claim_fingerprint(self, hashes, cue_path, index):
+        """
+        The earlier airing a song repeats like find_duplicate, otherwise its hashes are stored as a first airing.
+        Both happen in one write transaction, so workers processing two airings at once can't both miss the other.
+        """
+        # A repeat is found without taking the write lock, only a first airing needs to hold it
+        duplicate = self.find_duplicate(hashes, cue_path, index)
+        if duplicate is not None:
+            return duplicate
+        connection = self._connection()
+        # Transactions are handled here, so the lock is taken before the lookup rather than at the first insert
+        connection.isolation_level = None
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                duplicate = self.find_duplicate(hashes, cue_path, index)
+                if duplicate is None:
+                    self._store_fingerprint(connection, cue_path, index, hashes)
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.isolation_level = ""
+        return duplicate
+
+    def add_duplicate(self, cue_path, index, duplicate):
+        self._write([("INSERT OR REPLACE INTO duplicates (song_id, original_id, action) "
+                      "SELECT song.id, original.id, ? FROM songs AS song, songs AS original "
+                      "WHERE song.cue_path = ? AND song.song_index = ? "
+                      "AND original.cue_path = ? AND original.song_index = ?",
+                      (duplicate["action"], cue_path, index, duplicate["cue_path"], duplicate["index"]))])
+
+    def find_duplicate(self, hashes, cue_path=None, index=None):
+        """
+        The fingerprinted song sharing the most hashes at one frame offset with hashes, if enough do.
+        """
+        connection = self._connection()
+        own = connection.execute("SELECT id FROM songs WHERE cue_path = ? AND song_index = ?",
+                                 (cue_path, index)).fetchone()
+        frames = {}
+        for value, frame in hashes:
+            frames.setdefault(value, []).append(frame)
+        values = list(frames)
+        votes = {}
+        # Within SQLite's limit of bound parameters per statement
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            for value, song_id, frame in connection.execute(
+                    "SELECT hash, song_id, frame FROM fingerprints WHERE hash IN (%s)" % ",".join("?" * len(chunk)),
+                    chunk):
+                if own and song_id == own[0]:
+                    continue
+                for other in frames[value]:
+                    key = (song_id, frame - other)
+                    votes[key] = votes.get(key, 0) + 1
+        if not votes:
+            return None
+        (song_id, offset), count = max(votes.items(), key=lambda vote: vote[1])
+        if count < FINGERPRINT_MIN_MATCHES:
+            return None
+        original_cue, original_index, title, file_path = connection.execute(
+            "SELECT cue_path, song_index, title, file_path FROM songs WHERE id = ?", (song_id,)).fetchone()
+        files = dict(((profile, part), path) for profile, part, path in connection.execute(
+            "SELECT profile, part, path FROM files WHERE song_id = ?", (song_id,)))
+        return {"cue_path": original_cue, "index": original_index, "title": title, "file_path": file_path,
+                "files": files, "matches": count}
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        The newest songs matching a full text query, like artist:name or "exact title".
+        """
+        return self._connection().execute(
+            "SELECT songs.station, songs.dj, songs.artist, songs.title, songs.air_time, songs.duration, "
+            "songs.file_path, songs.bytes FROM songs_fts JOIN songs ON songs.id = songs_fts.docid "
+            "WHERE songs_fts MATCH ? ORDER BY songs.air_time DESC LIMIT ?", (query, limit)).fetchall()
+
+
+def search_catalog(query):
+    """
+    Print the songs in the catalog under FILE_PATH matching query.
+    """
+    start = time.time()
+    catalog = Catalog(os.path.join(FILE_PATH, CATALOG_FILE_NAME))
     try:
-        while not panic_lock.acquire(blocking=0):
-            stream_data.update()
-            if stream_data.title != current_title:
-                current_song = SongData(
-                    song_index, location, current_title, audio_extension, dj,
-                    dj_ext, bitrate,  float(time.time() - song_start), album)
-                to_write = [current_song, True]
-                pickle.dump(to_write, cue_file)
-                safe_stdout(WHITE_SPACE)
-                song_index += 1
-                safe_stdout("\r%.3d. %s %s" % (song_index, stream_data.title,
-                                               format_with_hours(time.time() - recording_start)))
-                safe_stdout('\n')
-                song_start = time.time()
-                current_title = stream_data.title
-                bitrate = stream_data.bitrate
-                audio_extension = SERVER_TYPES.get(
-                    stream_data.server_type, stream_data.server_type)
-                if CHECK_FOR_DJ:
-                    new_dj = get_dj()
-                    if new_dj != dj:
-                        if new_dj in EXCLUDE_DJ:
-                            safe_stdout("\nExcluded DJ detected, skipping %s" % dj)
-                            safe_stdout("\n")
-                            raise ExcludedDjException
-                        raise NewDjException
-            safe_stdout("\r%s: %s %skbps | DJ: %s | Listeners: %.04d | %s / %s" % (
-                stream_data.server_name, audio_extension.upper(), bitrate, dj,
-                stream_data.listeners, format_seconds(time.time() - song_start),
-                format_with_hours(time.time() - recording_start)))
-            time.sleep(SONG_CHECK_INTERVAL)
-    except KeyboardInterrupt:
-        safe_stdout("\nCleaning up and exiting program..")
-        current_song = SongData(
-            song_index, location, current_title, audio_extension, dj, dj_ext,
-            bitrate, float(time.time() - song_start), album)
-        to_write = [current_song, False]
-        pickle.dump(to_write, cue_file)
-        writer_lock.release()
-        writer_thread.join()
-        return False, cue_path
-    except NewDjException:
-        safe_stdout("\nSetting up for next DJ..\n")
-    except ExcludedDjException:
-        safe_stdout("Starting new stream block..\n")
-    except RequestException:
-        safe_stdout("\nError in the query, restarting recording..\n")
-    writer_lock.release()
-    writer_thread.join()
-    return True, cue_path
+        rows = catalog.search(query)
+    except sqlite3.Error as e:
+        print "Invalid search %s, %s" % (query, e)
+        return
+    for station, dj, artist, title, air_time, duration, file_path, size in rows:
+        print "%s %s | %s - %s | %s | DJ: %s" % (
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(air_time)), format_seconds(duration or 0), artist, title,
+            station, dj or "-")
+        if file_path:
+            print "    %s (%.1fMB)" % (file_path, (size or 0) / 1048576.0)
+    print "%d songs in %.1fms" % (len(rows), (time.time() - start) * 1000)
 
 
 def safe_query(query):
     start = time.time()
     printed = False
+    delay = 1.0
     while True:
         try:
-            return PyQuery(query)
+            return HTTP.page(query)
         except:
             if not printed:#0 < TIMEOUT < time.time() - start:
                 print ("\nPyQuery timed out")  # with the following message: %s" % e.message)
                 printed = True
                 #raise e
-            time.sleep(1.0)
+            time.sleep(delay)
+            delay = min(delay * 2, QUERY_RETRY_MAX)
 
 
-def get_dj():
-    query = safe_query(DJ_URL)
-    tag = query(DJ_ELEMENT)
-    return unicode(tag.text())
+def compile_rules(rules):
+    """
+    Include rules from the config, each either a regex searched in the whole stream title, or a dict of
+    title, artist and dj regexes that all have to match.
+    """
+    compiled = []
+    for rule in rules:
+        if not isinstance(rule, dict):
+            rule = {"stream_title": rule}
+        compiled.append(dict((field, re.compile(pattern, re.IGNORECASE)) for field, pattern in rule.items()))
+    return compiled
+
 
+def matches_rules(rules, song):
+    fields = {"stream_title": song.raw_title, "title": song.title, "artist": song.artist, "dj": song.dj}
+    return any(all(pattern.search(fields.get(field) or "") for field, pattern in rule.items()) for rule in rules)
 
-def get_dj_art():
-    query = safe_query(DJ_URL)
-    img_src = query(DJ_IMG_ELEMENT).attr('src')
-    return DJ_URL + img_src
 
+class ClipExporter:
+    """
+    Takes the place of the PostProcessor in capture mode, writing out of the block's ring buffer only the songs
+    that match the station's include rules or were asked for through the local API.
+    """
+    def __init__(self, station, cue_path, block, ring):
+        self.station = station
+        self.cue_path = cue_path
+        self.block = block
+        self.ring = ring
+        self.lock = threading.Lock()
+        # Songs that ended and may still be buffered, and the indexes asked for before they ended
+        self.ended = {}
+        self.requested = set()
+        self.exported = set()
+        self.jobs = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit_song(self, cue_path, record, block=None, segment_starts=None):
+        song = SongData.from_record(record, self.block, self.ring.location)
+        with self.lock:
+            oldest = self.ring.oldest()
+            for index in [index for index, ended in self.ended.items() if ended["end_position"] <= oldest]:
+                del self.ended[index]
+            self.ended[record["index"]] = record
+            if record["index"] in self.requested or matches_rules(self.station.include, song):
+                self.requested.discard(record["index"])
+                self._queue(record)
+
+    def request(self, index):
+        """
+        Export the song logged under index now if it has ended, otherwise once it ends.
+        """
+        with self.lock:
+            status = "queued"
+            if index in self.exported:
+                status = "exported"
+            elif index in self.ended:
+                if self.ended[index]["start_position"] < self.ring.oldest():
+                    status = "partial"
+                self._queue(self.ended[index])
+            elif not self.ended or index > max(self.ended):
+                self.requested.add(index)
+                status = "pending"
+            else:
+                status = "expired"
+        return {"station": self.station.name, "index": index, "status": status}
 
-def backup_get_title():
-    query = safe_query(DJ_URL)
-    tag = query(NP_ELEMENT)
-    return unicode(tag.text())
+    def _queue(self, record):
+        if record["index"] not in self.exported:
+            self.exported.add(record["index"])
+            self.jobs.put(record)
+
+    def _run(self):
+        while True:
+            record = self.jobs.get()
+            if record is None:
+                return
+            if record["start_position"] < self.ring.oldest():
+                self.station.stdout("\rOnly the end of %s was still buffered\n" % record["title"])
+            try:
+                processor = SongProcessor(self.cue_path)
+                processor.process_record(record, self.block, self.ring)
+                if self.station.catalog:
+                    self.station.catalog.queue("add_files", self.cue_path, record["index"], processor.files)
+                self.station.stdout("\rCaptured %.3d. %s\n" % (record["index"], record["title"]))
+            except Exception as e:
+                self.station.stdout("\rFailed to capture %s, %s: %s\n" % (record["title"], type(e).__name__, e))
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+
+class AdaptivePoller:
+    """
+    Intervals between a station's status polls. Where the audio can be watched for silence, songs are expected to
+    end in one, so polls are POLL_SILENT_INTERVAL apart and every SONG_CHECK_INTERVAL for POLL_SILENCE_WINDOW after a
+    silence. Once a song change comes without a silence, or without watching the audio, it polls slowly early in a
+    track and every SONG_CHECK_INTERVAL once it nears the station's typical track length, learnt as a moving average,
+    or runs past it. Backs off exponentially on errors.
+    """
+    def __init__(self, interval=None, max_interval=None):
+        self.interval = interval or SONG_CHECK_INTERVAL
+        self.max_interval = max_interval or POLL_MAX_INTERVAL
+        self.track_length = None
+        self.failures = 0
+        self.polls = 0
+        self.errors = 0
+        # Whether silences in the audio are watched, whether the last song change came with one, and until when
+        # the latest silence is polled for
+        self.watching = False
+        self.silent_ends = True
+        self.silent_until = None
+        self.silences = 0
+
+    def silence(self):
+        self.silences += 1
+        self.silent_until = time.time() + POLL_SILENCE_WINDOW
+
+    def track_ended(self, length):
+        if self.track_length is None:
+            self.track_length = length
+        else:
+            self.track_length += POLL_LEARNING_RATE * (length - self.track_length)
+        # Noticed by a poll within the window of a silence
+        self.silent_ends = self.silent_until is not None and time.time() < self.silent_until + self.interval
+        self.silent_until = None
+
+    def next_interval(self, elapsed, success):
+        """
+        Seconds until the next poll, given the seconds since the track started and whether this poll worked.
+        """
+        self.polls += 1
+        if not success:
+            self.errors += 1
+            self.failures += 1
+            return min(self.interval * 2 ** self.failures, self.max_interval)
+        self.failures = 0
+        if self.silent_until is not None and time.time() < self.silent_until:
+            return self.interval
+        if self.watching and self.silent_ends:
+            # The next silence wakes the poll, nothing is gained by polling near the expected end
+            return POLL_SILENT_INTERVAL
+        if self.track_length is None:
+            return self.interval
+        # Polled as often as before from POLL_GUARD of the way through a track and once it runs long,
+        # so a change is never noticed more than SONG_CHECK_INTERVAL late near the expected end
+        left = self.track_length * (1 - POLL_GUARD) - elapsed
+        if left <= 0:
+            return self.interval
+        return min(max(left * POLL_FRACTION, self.interval), self.max_interval)
+
+    def stats(self):
+        return "Polled status %d times, %d failed, %d after a silence, typical track %s" % (
+            self.polls, self.errors, self.silences,
+            format_seconds(self.track_length) if self.track_length else "unknown")
+
+
+class Scheduler:
+    """
+    Named timers for a station's main loop. wait() sleeps until the next timer is due or another thread
+    calls wake(), on a pipe with select so an idle station doesn't wake up at all.
+    """
+    def __init__(self):
+        self.timers = {}
+        if os.name == "posix":
+            self.event = None
+            self.read_fd, self.write_fd = os.pipe()
+        else:
+            # select only takes sockets on Windows
+            self.event = threading.Event()
+
+    def schedule(self, name, delay):
+        self.timers[name] = time.time() + delay
+
+    def cancel(self, name):
+        self.timers.pop(name, None)
+
+    def clear(self):
+        self.timers = {}
+
+    def wake(self):
+        """
+        Safe to call from any thread.
+        """
+        if self.event:
+            self.event.set()
+        else:
+            os.write(self.write_fd, "\0")
+
+    def sleep(self, seconds):
+        """
+        Sleep for up to seconds, or until woken. Returns whether it was woken.
+        """
+        if self.event:
+            woken = self.event.wait(seconds)
+            self.event.clear()
+            return woken
+        if seconds is not None:
+            seconds = max(seconds, 0)
+        if select.select([self.read_fd], [], [], seconds)[0]:
+            os.read(self.read_fd, 4096)
+            return True
+        return False
+
+    def wait(self):
+        """
+        Sleep until a timer is due or wake() is called, returns the names of the due timers and removes them.
+        """
+        if self.timers:
+            self.sleep(min(self.timers.values()) - time.time())
+        else:
+            self.sleep(None)
+        now = time.time()
+        due = [name for name, when in self.timers.items() if when <= now]
+        for name in due:
+            del self.timers[name]
+        return due
+
+
+class Station:
+    """
+    Everything needed to record a single stream, several of these can record side by side in one process.
+    """
+    def __init__(self, name, config, quiet=False, post=None, art=None, catalog=None):
+        self.name = name
+        self.post = post
+        self.catalog = catalog
+        self.art = art or ArtCache(os.path.join(FILE_PATH, ART_CACHE_DIR))
+        self.stream_url, self.xsl_url = verify_config(config)
+        self.dj_url = config.get("dj_url", "")
+        self.dj_element = config.get("dj_element", "")
+        self.dj_img_element = config.get("dj_img_element", "")
+        self.np_element = config.get("np_element")
+        self.exclude_dj = config.get("exclude_dj", [])
+        self.cue_only = bool(config.get("cue_only"))
+        self.icy_metadata = bool(config.get("icy_metadata"))
+        self.live_silence = bool(config.get("live_silence"))
+        # Capture mode keeps this many minutes in memory and only writes out the songs asked for
+        self.capture = float(config.get("capture") or 0)
+        self.include = compile_rules(config.get("include", []))
+        self.exporter = None
+        self.song_index = 0
+        self.file_path = config.get("file_path", FILE_PATH)
+        self.check_for_dj = False
+        self.quiet = quiet
+        self.stop_event = threading.Event()
+        self.scheduler = Scheduler()
+        self.poller = AdaptivePoller()
+        self.bytes_received = 0
+        METRICS.register(self._metrics)
+        if self.capture:
+            CAPTURES[self.name] = self
+        self.stream_data = StreamData(self.xsl_url, self)
+        # Kept between blocks so a DJ change hands the connection over to the next block
+        self.recorder = None
+        self.handover_time = None
+        # When run() started and the first audio arrived, for the time to first byte
+        self.started = None
+        self.first_byte = None
+        # Stream position and time of the status poll at startup, the first block's title changes are placed after
+        # it, and whether the DJ page has shown a DJ, None until it answers
+        self.startup_poll = None
+        self.dj_detected = None
+        # The block's writer, and the writes of the writers before it
+        self.writer = None
+        self.writes = 0
+        self.write_seconds = 0.0
+        self.slowest_write = 0.0
+
+    def stdout(self, to_print, status=False):
+        """
+        Print to the terminal, when several stations share it only whole lines are printed, prefixed by the station.
+        """
+        if not self.quiet:
+            safe_stdout(to_print)
+        elif not status and to_print.strip():
+            with STDOUT_LOCK:
+                safe_stdout("[%s] %s\n" % (self.name, to_print.strip()))
+
+    def check_stop(self):
+        if self.stop_event.is_set():
+            raise StopRecording
+
+    def stop(self):
+        self.stop_event.set()
+        self.scheduler.wake()
+
+    def detect_dj(self):
+        self.dj_detected = bool(self.dj_url and self.dj_element and self.get_dj() != "")
+        return self.dj_detected
+
+    def poll_startup(self, deadline):
+        """
+        Poll the status page until it answers. Audio is only held in memory until the deadline, then the stream's
+        own headers stand in for the status page, or without them the recorder is stopped until it answers.
+        """
+        while not self.stream_data.poll():
+            if self.recorder and time.time() >= deadline:
+                if self.stream_data.from_headers(self.recorder.request.headers):
+                    self.stdout("\rThe status page didn't answer, recording with the stream's headers\n")
+                    break
+                self.stdout("\rThe status page didn't answer, waiting for it before recording\n")
+                self.stop_recorder()
+            self.scheduler.sleep(SONG_CHECK_INTERVAL)
+        self.startup_poll = (self.recorder.received if self.recorder else 0, time.time())
+
+    def get_dj(self):
+        query = safe_query(self.dj_url)
+        tag = query(self.dj_element)
+        return unicode(tag.text())
+
+    def get_dj_art(self):
+        query = safe_query(self.dj_url)
+        img_src = query(self.dj_img_element).attr('src')
+        return self.dj_url + img_src
+
+    def backup_get_title(self):
+        query = safe_query(self.dj_url)
+        tag = query(self.np_element)
+        return unicode(tag.text())
+
+    def swap_djs(self, location, name):
+        """
+        Put the DJ's art in the block folder and return its extension, None when it can't be had.
+        """
+        try:
+            art_path, dj_image_extension = self.art.fetch(name, self.get_dj_art())
+            link_or_copy(art_path, os.path.join(location, "%s.%s" % (name, dj_image_extension)))
+        except (requests.exceptions.RequestException, EnvironmentError, TypeError) as e:
+            # TypeError when the DJ page has no art element, the block is recorded without art
+            self.stdout("\rNo art for DJ %s, %s" % (name, e))
+            self.stdout("\n")
+            return None
+        return dj_image_extension
+
+    def add_writer(self, writer):
+        if self.writer:
+            stats = self.writer.stats()
+            self.writes += stats["writes"]
+            self.write_seconds += stats["write_seconds"]
+            self.slowest_write = max(self.slowest_write, stats["slowest_write_seconds"])
+        self.writer = writer
+
+    def _metrics(self):
+        received = self.bytes_received + (self.recorder.total_received if self.recorder else 0)
+        metrics = [("pyss_bytes_received_total", "counter", {"station": self.name}, received)]
+        if self.writer:
+            stats = self.writer.stats()
+            metrics += [("pyss_writes_total", "counter", {"station": self.name}, self.writes + stats["writes"]),
+                        ("pyss_write_seconds_total", "counter", {"station": self.name},
+                         self.write_seconds + stats["write_seconds"]),
+                        ("pyss_write_seconds_max", "gauge", {"station": self.name},
+                         max(self.slowest_write, stats["slowest_write_seconds"]))]
+        if self.first_byte:
+            metrics.append(("pyss_first_byte_seconds", "gauge", {"station": self.name}, self.first_byte - self.started))
+        return metrics
+
+    def capture_song(self, index=None):
+        """
+        Write a song of the current block out of the ring buffer, by default the one on air once it ends.
+        """
+        exporter = self.exporter
+        if exporter is None:
+            return {"station": self.name, "index": index, "status": "not recording"}
+        return exporter.request(self.song_index if index is None else index)
+
+    def close_exporter(self):
+        if self.exporter:
+            self.exporter.close()
+            self.exporter = None
+
+    def start_recorder(self):
+        """
+        Connect and start recording before the block is set up, so no audio is lost to looking up the DJ.
+        Returns the recorder, or None if stopped first.
+        """
+        recorder = StreamRecorder(self.stream_url, self.cue_only, self.icy_metadata, self.name)
+        recorder.notify = self.scheduler.wake
+        if recorder.connect(self.stop_event) is None:
+            return None
+        if self.icy_metadata and not recorder.metaint:
+            self.stdout("\rStream has no icy-metaint, falling back to status polling\n")
+        recorder.buffer()
+        self.recorder = recorder
+        self.handover_time = time.time()
+        return recorder
+
+    def stop_recorder(self):
+        if self.recorder:
+            self.recorder.stop()
+            self.bytes_received += self.recorder.total_received
+            self.recorder = None
+
+    def begin_recording(self):
+        """
+        Returns first whether to continue recording, and secondly if the recording is incomplete.
+        """
+        stream_data = self.stream_data
+        song_index = 1
+        dj = ""
+        dj_ext = ""
+
+        try:
+            if self.check_for_dj:
+                dj_found = False
+                while not dj_found:
+                    self.check_stop()
+                    new_dj = self.get_dj()
+                    if new_dj != dj:
+                        if new_dj in self.exclude_dj:
+                            self.stdout("\rExcluded DJ detected, skipping %s" % new_dj)
+                            self.stop_recorder()
+                            self.scheduler.sleep(DJ_CHECK_INTERVAL)
+                            continue
+                        dj = new_dj
+                        dj_found = True
+        except (KeyboardInterrupt, StopRecording):
+            self.stdout("\nQuitting program..")
+            self.stop_recorder()
+            return False, None
+
+        folder_name = album = str(int(time.time()))
+        if dj:
+            folder_name += " %s" % dj
+        location = os.path.join(self.file_path, folder_name)
+        os.mkdir(location)
+        cue_path = os.path.join(location, CUE_FILE_NAME)
+        cue = CueWriter(cue_path)
+
+        if self.check_for_dj:
+            dj_ext = self.swap_djs(location, dj)
+            self.stdout(WHITE_SPACE)
+            self.stdout("\rDJ %s has taken over the stream." % dj)
+            self.stdout("\n")
+            block = {"version": CUE_VERSION, "dj": dj, "dj_ext": dj_ext, "album": album, "time": time.time()}
+        else:
+            block = {"version": CUE_VERSION, "dj": None, "dj_ext": None, "album": album, "time": time.time()}
+        capture = self.capture and not self.cue_only
+        if capture:
+            block["capture"] = True
+        cue.write("block", **block)
+
+        bitrate = stream_data.bitrate
+        if capture:
+            writer = RingBuffer(location, int(self.capture * 60 * float(bitrate) * 125))
+        else:
+            writer = SegmentWriter(location, cue=cue)
+        self.add_writer(writer)
+        recorder = self.recorder
+        if recorder:
+            # The previous block ended at a song change, this one starts with the audio recorded since
+            recorder.hand_over(writer, cue)
+            song_start = self.handover_time
+        else:
+            recorder = self.recorder = StreamRecorder(self.stream_url, self.cue_only, self.icy_metadata, self.name)
+            recorder.notify = self.scheduler.wake
+            if (self.icy_metadata or not self.cue_only) and recorder.connect(self.stop_event) is None:
+                self.recorder = None
+                cue.write("end", position=0, time=time.time())
+                cue.close()
+                self.stdout("\nQuitting program..")
+                return False, cue_path
+            if self.icy_metadata and not recorder.metaint:
+                self.stdout("\rStream has no icy-metaint, falling back to status polling\n")
+            recorder.start(writer, cue)
+            song_start = time.time()
+        metaint = recorder.metaint
+        current_title = stream_data.title
+        song_position = 0
+        end_position = None
+        remaining = []
+        recording_start = song_start
+        scheduler = self.scheduler
+        scheduler.clear()
+        scheduler.schedule("status", STATUS_FALLBACK_INTERVAL if metaint else SONG_CHECK_INTERVAL)
+        if not self.quiet:
+            scheduler.schedule("display", 0)
+        last_poll = self.startup_poll or (recorder.received, time.time())
+        self.startup_poll = None
+        audio_extension = SERVER_TYPES.get(stream_data.server_type,
+                                           stream_data.server_type)
+        self.poller.watching = not metaint and not self.cue_only and audio_extension == "mp3"
+        self.song_index = song_index
+        if capture:
+            self.exporter = ClipExporter(self, cue_path, block, writer)
+            songs = BoundaryWorker(cue, location, SILENCE_LOOKAHEAD + 1, None, cut=self.live_silence,
+                                   post=self.exporter, reader=writer, block=block)
+        elif (self.live_silence or self.post) and not self.cue_only:
+            # Songs reach the cue once the audio after their boundary has been flushed
+            songs = BoundaryWorker(cue, location, SILENCE_LOOKAHEAD + 1 + WRITE_BUFFER_SIZE / (float(bitrate) * 125),
+                                   writer.segment_starts, cut=self.live_silence, post=self.post, block=block)
+        else:
+            songs = cue
+        self.stdout("%.3d. %s %s" % (song_index, stream_data.title,
+                                     format_with_hours(time.time() - recording_start)))
+        self.stdout("\n")
+
+        try:
+            while not recorder.failed.is_set():
+                due = scheduler.wait()
+                self.check_stop()
+                if recorder.first_byte and not self.first_byte:
+                    self.first_byte = recorder.first_byte
+                    self.stdout("\rFirst audio %.2fs after starting\n" % (self.first_byte - self.started))
+                while not recorder.gaps.empty():
+                    self.stdout("\rStream dropped, reconnected after %.2fs\n" % recorder.gaps.get()[1])
+                changes = []
+                # Titles come from the stream at their exact byte offset, status-json is only for listener counts
+                while metaint and not recorder.titles.empty():
+                    changes.append(recorder.titles.get())
+                if recorder.silence.is_set():
+                    # Songs end in silence, so the title is polled for right away
+                    recorder.silence.clear()
+                    if not metaint:
+                        self.poller.silence()
+                        scheduler.cancel("status")
+                        if "status" not in due:
+                            due.append("status")
+                if "status" in due:
+                    poll_start = time.time()
+                    success = stream_data.poll()
+                    METRICS.observe("pyss_status_poll_seconds", time.time() - poll_start, station=self.name)
+                    if not success:
+                        METRICS.inc("pyss_status_poll_failures_total", station=self.name)
+                    delay = self.poller.next_interval(time.time() - song_start, success)
+                    if success and metaint:
+                        delay = STATUS_FALLBACK_INTERVAL
+                    scheduler.schedule("status", delay)
+                    if success and not metaint:
+                        poll = (recorder.received, time.time())
+                        if stream_data.title != current_title:
+                            # The title changed somewhere since the last poll, the middle is the best guess
+                            changes.append((max((last_poll[0] + poll[0]) // 2, song_position),
+                                            (last_poll[1] + poll[1]) / 2, stream_data.title, False))
+                        last_poll = poll
+                for i, (position, change_time, title, initial) in enumerate(changes):
+                    if initial:
+                        current_title = stream_data.title = title
+                        continue
+                    self.write_song(songs, writer, song_index, current_title, audio_extension, bitrate,
+                                    song_position, position, song_start, change_time, True)
+                    self.catalog_song(cue_path, block, song_index, current_title, audio_extension, bitrate,
+                                      song_position, position, song_start)
+                    song_position = position
+                    METRICS.inc("pyss_songs_total", station=self.name)
+                    self.poller.track_ended(change_time - song_start)
+                    self.stdout(WHITE_SPACE, status=True)
+                    song_index += 1
+                    self.song_index = song_index
+                    self.stdout("\r%.3d. %s %s" % (song_index, title,
+                                                   format_with_hours(change_time - recording_start)))
+                    self.stdout('\n')
+                    song_start = change_time
+                    current_title = stream_data.title = title
+                    bitrate = stream_data.bitrate
+                    audio_extension = SERVER_TYPES.get(
+                        stream_data.server_type, stream_data.server_type)
+                    if not self.check_for_dj and self.dj_detected:
+                        # The DJ page answered after recording started, the DJ on air now gets their own block
+                        self.check_for_dj = True
+                    if self.check_for_dj:
+                        new_dj = self.get_dj()
+                        if new_dj != dj:
+                            if new_dj in self.exclude_dj:
+                                self.stdout("\nExcluded DJ detected, skipping %s" % dj)
+                                self.stdout("\n")
+                                raise ExcludedDjException
+                            remaining = changes[i + 1:]
+                            raise NewDjException
+                if "display" in due:
+                    self.stdout("\r%s: %s %skbps | DJ: %s | Listeners: %.04d | %s / %s" % (
+                        stream_data.server_name, audio_extension.upper(), bitrate, dj,
+                        stream_data.listeners, format_seconds(time.time() - song_start),
+                        format_with_hours(time.time() - recording_start)), status=True)
+                    scheduler.schedule("display", DISPLAY_INTERVAL)
+        except (KeyboardInterrupt, StopRecording):
+            self.stdout("\nCleaning up and exiting program..")
+            self.stop_recorder()
+            self.write_song(songs, writer, song_index, current_title, audio_extension, bitrate,
+                            song_position, recorder.received, song_start, time.time(), False)
+            self.catalog_song(cue_path, block, song_index, current_title, audio_extension, bitrate,
+                              song_position, recorder.received, song_start)
+            if songs is not cue:
+                songs.close()
+            self.close_exporter()
+            cue.write("end", position=recorder.received, time=time.time())
+            cue.close()
+            self.stdout("\n%s\n" % format_writer_stats(writer.stats()))
+            if not metaint:
+                self.stdout("%s\n" % self.poller.stats())
+            return False, cue_path
+        except NewDjException:
+            self.stdout("\nSetting up for next DJ..\n")
+            # The block ends at the song change, the recorder keeps going and holds the audio after it
+            end_position = song_position
+            if songs is not cue:
+                songs.split(song_position)
+            recorder.split(song_position, remaining)
+            self.handover_time = song_start
+        except ExcludedDjException:
+            self.stdout("Starting new stream block..\n")
+        except RequestException:
+            self.stdout("\nError in the query, restarting recording..\n")
+        if end_position is None:
+            self.stop_recorder()
+            end_position = recorder.received
+        if songs is not cue:
+            songs.close()
+        self.close_exporter()
+        cue.write("end", position=end_position, time=time.time())
+        cue.close()
+        self.stdout("%s\n" % format_writer_stats(writer.stats()))
+        if not metaint:
+            self.stdout("%s\n" % self.poller.stats())
+        return True, cue_path
+
+    @staticmethod
+    def write_song(songs, writer, index, title, extension, bitrate, start, end, start_time, end_time, complete):
+        """
+        Log a song to the cue (or to the BoundaryWorker holding it) as the byte range it covers in the segments,
+        first_segment is the earliest segment its post-processing reads.
+        """
+        margin = int(SILENCE_WINDOW * float(bitrate) * 125) + FRAME_SEARCH_WINDOW
+        songs.write("song", index=index, title=title, extension=extension, bitrate=bitrate,
+                    start=writer.locate(start), end=writer.locate(end),
+                    first_segment=writer.locate(max(start - margin, 0))[0],
+                    start_position=start, end_position=end, time=start_time, end_time=end_time,
+                    complete=complete)
+
+    def catalog_song(self, cue_path, block, index, title, extension, bitrate, start, end, start_time):
+        if self.catalog:
+            song = SongData(index, os.path.dirname(cue_path), title, extension, block["dj"] or "",
+                            block["dj_ext"] or "", bitrate, block["album"], start, end)
+            self.catalog.queue("add_song", cue_path, index, self.name, song, start_time)
+
+    def recording_loop(self):
+        do_continue = True
+        while do_continue:
+            do_continue, cue_file = self.begin_recording()
+            if cue_file and not self.cue_only and not self.capture and self.post:
+                self.post.submit_cue(cue_file)
+
+    def run(self):
+        """
+        Connect to the station and record until stopped.
+        """
+        self.started = time.time()
+        try:
+            if not os.path.isdir(self.file_path):
+                os.makedirs(self.file_path)
+            # Audio is recorded from the start, the DJ page and status are fetched meanwhile
+            if (self.icy_metadata or not self.cue_only) and self.start_recorder() is None:
+                return
+            # Keeps trying in the background when the DJ page is down, DJ detection starts once it answers
+            detector = threading.Thread(target=self.detect_dj)
+            detector.daemon = True
+            detector.start()
+            # The audio is held in memory until the block is set up, so the status and DJ pages only get so long
+            deadline = self.started + DJ_LOOKUP_TIMEOUT
+            self.poll_startup(deadline)
+            title = self.stream_data.title
+            while detector.is_alive() and time.time() < deadline:
+                # A timed join so Ctrl-C and stop() still get through
+                detector.join(min(SONG_CHECK_INTERVAL, max(deadline - time.time(), 0)))
+                self.check_stop()
+                if detector.is_alive() and self.stream_data.poll():
+                    if self.stream_data.title != title:
+                        # The song changed, the block starts now and its first poll logs the change
+                        self.stream_data.title = title
+                        break
+                    self.startup_poll = (self.recorder.received if self.recorder else 0, time.time())
+            if detector.is_alive():
+                self.stdout("\rThe DJ page hasn't answered yet, DJs are detected from the first song change after "
+                            "it does\n")
+            self.check_for_dj = bool(self.dj_detected)
+        except (KeyboardInterrupt, StopRecording):
+            self.stop_recorder()
+            return
+        except RequestException:
+            self.stop_recorder()
+            raise
+        self.stdout("Connected to %s\n" % self.stream_data.server_name)
+        self.stdout("%s\n" % self.stream_data.server_description)
+        self.recording_loop()
 
 
 def load_args():
@@ -561,7 +3198,7 @@ def load_args():
                 config_data['block_size'] = int(sys.argv[i + 1])
                 i += 1
             elif arg == "-dj_check_interval":
-                config_data['dj_check_interval'] = int(sys.argv[i + 1])
+                config_data['dj_check_interval'] = float(sys.argv[i + 1])
                 i += 1
             elif arg == "-dj_url":
                 config_data['dj_url'] = sys.argv[i + 1]
@@ -590,9 +3227,50 @@ def load_args():
             elif arg == "-np_element":
                 config_data['np_element'] = sys.argv[i + 1]
                 i += 1
+            elif arg == "-write_buffer":
+                config_data['write_buffer'] = int(sys.argv[i + 1])
+                i += 1
+            elif arg == "-fsync":
+                config_data['fsync'] = sys.argv[i + 1]
+                i += 1
             elif arg == "-cue_only":
                 config_data['cue_only'] = True
                 i += 1
+            elif arg == "-all":
+                config_data['all'] = True
+            elif arg == "-icy":
+                config_data['icy_metadata'] = True
+            elif arg == "-live_silence":
+                config_data['live_silence'] = True
+            elif arg == "-workers":
+                config_data['workers'] = int(sys.argv[i + 1])
+                i += 1
+            elif arg == "-metrics_port":
+                config_data['metrics_port'] = int(sys.argv[i + 1])
+                i += 1
+            elif arg == "-profile":
+                config_data['profile'] = True
+            elif arg == "-capture":
+                config_data['capture'] = float(sys.argv[i + 1])
+                i += 1
+            elif arg == "-capture_port":
+                config_data['capture_port'] = int(sys.argv[i + 1])
+                i += 1
+            elif arg == "-include":
+                config_data.setdefault('include', []).append(sys.argv[i + 1])
+                i += 1
+            elif arg == "-output":
+                config_data.setdefault('outputs', []).append(sys.argv[i + 1])
+                i += 1
+            elif arg == "-search":
+                config_data['search'] = sys.argv[i + 1]
+                i += 1
+            elif arg == "-duplicates":
+                config_data['duplicates'] = sys.argv[i + 1]
+                i += 1
+            elif arg == "-profile_dump":
+                config_data['profile'] = True
+                config_data['profile_dump'] = True
 
         i += 1
     return config_data
@@ -622,6 +3300,16 @@ def load_config(config_name):
     return data['configs'][config_name]
 
 
+def load_all_configs():
+    with open(CONFIG_FILE) as config:
+        data = json.load(config)
+    configs = data['configs']
+    for name in configs:
+        if configs[name].get('stream_url') and not configs[name].get('xsl_location'):
+            configs[name]['xsl_location'] = extract_xsl_from_link(configs[name]['stream_url'])
+    return configs
+
+
 def verify_config(config):
     try:
         return config["stream_url"], config["xsl_location"]
@@ -632,29 +3320,29 @@ def verify_config(config):
 
 
 def optional_config(config):
-    dj_url = config.get("dj_url")
-    dj_element = config.get("dj_element")
+    """
+    Apply the process wide settings, station specific settings are read by Station.
+    """
     save_flag = config.get("save_flag")
     timeout = config.get("timeout")
     file_path = config.get("file_path")
     block_size = config.get("block_size")
     dj_check_interval = config.get("dj_check_interval")
-    dj_img_element = config.get("dj_img_element")
-    exclude_dj = config.get("exclude_dj")
-    np_element = config.get("np_element")
-    cue = config.get("cue_only")
+    workers = config.get("workers")
+    write_buffer = config.get("write_buffer")
+    fsync = config.get("fsync")
+    metrics_port = config.get("metrics_port")
+    capture_port = config.get("capture_port")
+    profile = config.get("profile")
+    profile_dump = config.get("profile_dump")
+    outputs = config.get("outputs")
+    duplicates = config.get("duplicates")
 
     if save_flag:
         save_config(config)
     if timeout:
         global TIMEOUT
         TIMEOUT = timeout
-    if dj_url and dj_element:
-        global DJ_ELEMENT, DJ_URL, CHECK_FOR_DJ
-        DJ_URL = dj_url
-        DJ_ELEMENT = dj_element
-        if get_dj() != "":
-            CHECK_FOR_DJ = True
     if file_path:
         global FILE_PATH
         FILE_PATH = file_path
@@ -663,31 +3351,68 @@ def optional_config(config):
         BLOCK_SIZE = block_size
     if dj_check_interval:
         global DJ_CHECK_INTERVAL
-        DJ_CHECK_INTERVAL = DJ_CHECK_INTERVAL
-    if dj_img_element:
-        global DJ_IMG_ELEMENT
-        DJ_IMG_ELEMENT = dj_img_element
-    if exclude_dj:
-        global EXCLUDE_DJ
-        EXCLUDE_DJ = exclude_dj
-    if np_element:
-        global NP_ELEMENT
-        NP_ELEMENT = np_element
-    if cue:
-        global CUE_ONLY
-        CUE_ONLY = True
-
-
-def recording_loop(stream_url, stream_data):
-    do_continue = True
-    proc = None
-    while do_continue:
-        do_continue, cue_file = begin_recording(stream_data, stream_url)
-        if cue_file:
-            proc = SongProcessor(cue_file)
-            proc.mp_unpack()
-    if proc:
-        proc.join()
+        DJ_CHECK_INTERVAL = dj_check_interval
+    if workers:
+        global POST_WORKERS
+        POST_WORKERS = workers
+    if write_buffer:
+        global WRITE_BUFFER_SIZE
+        WRITE_BUFFER_SIZE = write_buffer
+    if fsync:
+        if fsync not in FSYNC_POLICIES:
+            print "Invalid fsync policy %s, expected one of %s" % (fsync, ", ".join(FSYNC_POLICIES))
+            quit()
+        global FSYNC_POLICY
+        FSYNC_POLICY = fsync
+    if metrics_port:
+        global METRICS_PORT
+        METRICS_PORT = metrics_port
+        METRICS.enabled = True
+    if capture_port:
+        global CAPTURE_PORT
+        CAPTURE_PORT = capture_port
+    if profile:
+        global PROFILE
+        PROFILE = True
+    if profile_dump:
+        global PROFILE_DUMP
+        PROFILE_DUMP = True
+    if outputs:
+        global OUTPUT_PROFILES
+        try:
+            OUTPUT_PROFILES = [parse_output(output) for output in outputs]
+        except ValueError as e:
+            print e
+            quit()
+    if duplicates:
+        if duplicates not in DUPLICATE_ACTIONS:
+            print "Invalid duplicates action %s, expected one of %s" % (duplicates, ", ".join(DUPLICATE_ACTIONS))
+            quit()
+        global DUPLICATES
+        DUPLICATES = duplicates
+
+
+def record_all(stations):
+    """
+    Record every station in its own thread of this process until they finish or Ctrl-C is pressed.
+    """
+    threads = []
+    for station in stations:
+        thread = threading.Thread(target=station.run, name=station.name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        while any(thread.is_alive() for thread in threads):
+            # join with a timeout so Ctrl-C still reaches the main thread
+            for thread in threads:
+                thread.join(1.0)
+    except KeyboardInterrupt:
+        safe_stdout("\nStopping all stations..\n")
+        for station in stations:
+            station.stop()
+        for thread in threads:
+            thread.join()
 
 
 def get_avg_delay(stream_xsl):
@@ -704,16 +3429,42 @@ def get_avg_delay(stream_xsl):
 
 def setup():
     config_data = load_args()
-    stream_url, stream_xsl = verify_config(config_data)
     optional_config(config_data)
-    request = requests.get(stream_url, stream=True)
-    stream_data = StreamData(stream_xsl)
-    stream_data.update()
-    safe_stdout("Connected to %s\n" % stream_data.server_name)
-    safe_stdout("%s\n" % stream_data.server_description)
-    return request, stream_data, stream_url
+    if config_data.get('search'):
+        search_catalog(config_data['search'])
+        quit()
+    catalog = Catalog(os.path.join(FILE_PATH, CATALOG_FILE_NAME))
+    # Start the workers before any station thread exists
+    post = PostProcessor(catalog=catalog)
+    art = ArtCache(os.path.join(FILE_PATH, ART_CACHE_DIR))
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+        safe_stdout("Serving metrics on http://127.0.0.1:%d/metrics\n" % METRICS_PORT)
+    if config_data.get('all'):
+        stations = []
+        for name, config in sorted(load_all_configs().items()):
+            config = dict(config)
+            config.setdefault('file_path', os.path.join(FILE_PATH, clean_name(name)))
+            if config_data.get('cue_only'):
+                config['cue_only'] = True
+            stations.append(Station(name, config, quiet=True, post=post, art=art, catalog=catalog))
+    else:
+        stations = [Station(config_data.get('stream_url', ''), config_data, post=post, art=art, catalog=catalog)]
+    if CAPTURES:
+        # The metrics server answers capture requests too when they share the port
+        if CAPTURE_PORT != METRICS_PORT:
+            serve_metrics(CAPTURE_PORT)
+        safe_stdout("Taking capture requests on http://127.0.0.1:%d/capture\n" % CAPTURE_PORT)
+    for path in sorted(set(station.file_path for station in stations)):
+        post.resume(path)
+    return stations, post
 
 
 if __name__ == "__main__":
-    setup_request, setup_data, setup_url = setup()
-    recording_loop(setup_url, setup_data)
+    setup_stations, setup_post = setup()
+    if len(setup_stations) == 1:
+        setup_stations[0].run()
+    else:
+        record_all(setup_stations)
+    safe_stdout("\nWaiting on post-processing..\n")
+    setup_post.join()
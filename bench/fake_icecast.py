@@ -0,0 +1,287 @@
+# Local Icecast stand-in for benchmarking PYSS, nothing here talks to a real station.
+# Serves a synthetic MP3 stream following a scripted timeline of tracks and DJs, along with
+# status-json.xsl, a DJ page and DJ art, so every boundary has a known ground truth.
+import time
+import sys
+import json
+import zlib
+import struct
+import socket
+import hashlib
+import argparse
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+BITRATE = 128  # kbps
+SAMPLE_RATE = 44100
+BYTES_PER_SECOND = BITRATE * 125
+FRAME_SAMPLES = 1152
+METAINT = 8192
+GAP = 1.5  # seconds of silence ending every track
+CHUNK_SIZE = 4096
+DEFAULT_SCRIPT = [
+    {"title": "Bench Artist - Opening", "dj": "Alpha", "duration": 20},
+    {"title": "Bench Artist - Second", "dj": "Alpha", "duration": 25},
+    {"title": "Other Artist - Third", "dj": "Alpha", "duration": 15},
+    {"title": "Other Artist - Handover", "dj": "Beta", "duration": 20},
+    {"title": "Third Artist - Fifth", "dj": "Beta", "duration": 30},
+    {"title": "Third Artist - Closing", "dj": "Beta", "duration": 20},
+]
+
+
+def silent_frames(seconds):
+    """
+    MPEG-1 layer III frames at BITRATE with empty side info, which decode to silence.
+    Frames are padded now and then like a real encoder so the stream averages exactly BYTES_PER_SECOND.
+    """
+    frames = []
+    exact = 144.0 * BITRATE * 1000 / SAMPLE_RATE
+    owed = 0.0
+    for _ in range(int(round(seconds * SAMPLE_RATE / FRAME_SAMPLES))):
+        owed += exact - int(exact)
+        padding = owed >= 1
+        if padding:
+            owed -= 1
+        # sync, MPEG-1, layer III, no CRC | 128kbps, 44.1kHz, padding | joint stereo
+        header = "\xff\xfb" + chr(0x90 | (2 if padding else 0)) + "\x64"
+        frames.append(header + "\0" * (int(exact) + padding - 4))
+    return "".join(frames)
+
+
+def tone_frames(seconds, silence, frequency):
+    """
+    A tone followed by silence, encoded by ffmpeg.
+    """
+    # Commas inside the expression are escaped, unescaped they would split the filtergraph
+    expression = r"if(lt(t\,%s)\,0.5*sin(2*PI*%s*t)\,0)" % (seconds - silence, frequency)
+    try:
+        return subprocess.check_output(
+            ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "aevalsrc=%s:d=%s:s=%s" % (expression, seconds, SAMPLE_RATE),
+             "-ac", "2", "-b:a", "%sk" % BITRATE, "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "-"])
+    except OSError as e:
+        raise RuntimeError("Couldn't run ffmpeg for the tones (%s), use --silent to bench without them" % e)
+
+
+def png(rgb):
+    """
+    A 1x1 PNG of the given colour, enough for imghdr and the ID3 cover art.
+    """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    return ("\x89PNG\r\n\x1a\n" + chunk("IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)) +
+            chunk("IDAT", zlib.compress("\0" + "".join(chr(c) for c in rgb))) + chunk("IEND", ""))
+
+
+class Timeline:
+    """
+    The audio of the scripted tracks back to back, with the byte position every track starts at.
+    Track boundaries are at the end of each track's closing silence.
+    """
+    def __init__(self, script=None, tones=True, lag=0.0):
+        self.script = script or DEFAULT_SCRIPT
+        # Seconds the titles and DJ page trail the audio, like on a real station
+        self.lag = lag
+        self.starts = []
+        audio = []
+        position = 0
+        self.tones = tones
+        for i, track in enumerate(self.script):
+            if tones:
+                frames = tone_frames(track["duration"], GAP, 220 * (i + 2))
+            else:
+                frames = silent_frames(track["duration"])
+            self.starts.append(position)
+            audio.append(frames)
+            position += len(frames)
+        self.audio = "".join(audio)
+        self.length = position
+
+    def index_at(self, position):
+        position -= int(self.lag * BYTES_PER_SECOND)
+        index = 0
+        for i, start in enumerate(self.starts):
+            if start <= position:
+                index = i
+        return index
+
+    def ground_truth(self):
+        """
+        Byte position of every title change and the silence before it, as [start of silence, boundary] pairs.
+        """
+        return [{"position": start, "silence": [start - int(GAP * BYTES_PER_SECOND), start],
+                 "title": self.script[i]["title"], "dj": self.script[i]["dj"]}
+                for i, start in enumerate(self.starts) if i]
+
+    def duration(self):
+        return self.length / float(BYTES_PER_SECOND)
+
+
+class FakeIcecast(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the timeline on /stream at speed times real time (0 streams it as fast as possible, looped),
+    the clock of status-json.xsl and the DJ page starts with the first stream request.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, timeline, port=0, speed=1.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), FakeIcecastHandler)
+        self.timeline = timeline
+        self.speed = speed
+        self.started = None
+        self.listeners = 0
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def position(self):
+        if self.started is None or not self.speed:
+            return 0
+        return int((time.time() - self.started) * self.speed * BYTES_PER_SECOND)
+
+    def track(self):
+        return self.timeline.script[self.timeline.index_at(self.position())]
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def handle_error(self, request, client_address):
+        # Listeners hanging up mid-stream is how every stream ends, not an error
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class FakeIcecastHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type):
+        # ETag revalidation, the way PYSS talks to real stations
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        server.count(path)
+        if path == "/stream":
+            self.stream()
+        elif path == "/status-json.xsl":
+            track = server.track()
+            status = {"icestats": {"source": [
+                {"bitrate": BITRATE},
+                {"server_name": "PYSS Bench", "server_type": "audio/mpeg", "server_description": "Fake Icecast",
+                 "listener_peak": server.listeners, "listeners": server.listeners, "title": track["title"]}]}}
+            self._send(json.dumps(status), "application/json")
+        elif path == "/":
+            track = server.track()
+            page = ('<html><body><span id="dj">%s</span><img id="dj-art" src="art/%s.png"/>'
+                    '<span id="np">%s</span></body></html>' % (track["dj"], track["dj"], track["title"]))
+            self._send(page, "text/html")
+        elif path.startswith("/art/"):
+            self._send(png([ord(c) for c in hashlib.md5(path).digest()[:3]]), "image/png")
+        else:
+            self.send_error(404)
+
+    def stream(self):
+        server = self.server
+        timeline = server.timeline
+        metaint = METAINT if self.headers.get("Icy-MetaData") == "1" else None
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("icy-br", str(BITRATE))
+        self.send_header("icy-name", "Bench")
+        if metaint:
+            self.send_header("icy-metaint", str(metaint))
+        self.end_headers()
+        with server.lock:
+            if server.started is None:
+                server.started = time.time()
+            server.listeners += 1
+        start = time.time()
+        sent = 0
+        until_meta = metaint
+        title = None
+        try:
+            while True:
+                if server.speed:
+                    due = int((time.time() - start) * server.speed * BYTES_PER_SECOND)
+                    if sent >= due:
+                        time.sleep(.01)
+                        continue
+                    size = min(CHUNK_SIZE, due - sent)
+                else:
+                    size = CHUNK_SIZE
+                if metaint:
+                    size = min(size, until_meta)
+                offset = sent % timeline.length if not server.speed else sent
+                if offset >= timeline.length:
+                    # Past the script, the station goes quiet but stays on air
+                    data = "\0" * size
+                else:
+                    data = timeline.audio[offset:offset + size]
+                self.wfile.write(data)
+                sent += len(data)
+                if metaint:
+                    until_meta -= len(data)
+                    if not until_meta:
+                        until_meta = metaint
+                        current = timeline.script[timeline.index_at(min(sent, timeline.length - 1))]["title"]
+                        if current != title:
+                            title = current
+                            meta = "StreamTitle='%s';" % title
+                            meta += "\0" * (-len(meta) % 16)
+                            self.wfile.write(chr(len(meta) // 16) + meta)
+                        else:
+                            self.wfile.write("\0")
+        except (IOError, OSError):
+            pass
+        finally:
+            with server.lock:
+                server.listeners -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a scripted fake Icecast station.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--speed", type=float, default=1.0, help="times real time, 0 for as fast as possible")
+    parser.add_argument("--script", help="JSON list of {title, dj, duration} tracks")
+    parser.add_argument("--silent", action="store_true", help="don't encode tones with ffmpeg")
+    args = parser.parse_args()
+    script = None
+    if args.script:
+        with open(args.script) as script_file:
+            script = json.load(script_file)
+    server = FakeIcecast(Timeline(script, tones=not args.silent), args.port, args.speed)
+    sys.stdout.write("Streaming on %sstream, DJ page on %s\n" % (server.url, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# Benchmarks PYSS against the local fake Icecast server in fake_icecast.py.
+# Results are saved as JSON under bench/results so runs can be compared across versions:
+#   python bench/run_bench.py [--speed 1] [--modes status,icy] [--throughput 64]
+#   python bench/run_bench.py --compare old.json new.json
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import threading
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import PYSS
+from fake_icecast import FakeIcecast, Timeline, BYTES_PER_SECOND
+
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+STOP_MARGIN = 15  # seconds recorded past the script so the last change is noticed and logged
+
+
+def summarise(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {"mean": sum(values) / len(values), "p50": values[len(values) // 2], "max": values[-1],
+            "count": len(values)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_recorder_throughput(megabytes):
+    """
+    How fast StreamRecorder moves a local stream served as fast as possible into its segments.
+    """
+    server = FakeIcecast(Timeline(tones=False), speed=0).start()
+    location = tempfile.mkdtemp(prefix="pyss-bench-")
+    try:
+        recorder = PYSS.StreamRecorder(server.url + "stream")
+        recorder.connect(threading.Event())
+        writer = PYSS.SegmentWriter(location)
+        start = time.time()
+        recorder.start(writer, None)
+        while recorder.total_received < megabytes * 1048576 and not recorder.failed.is_set():
+            time.sleep(.05)
+        elapsed = time.time() - start
+        recorder.stop()
+        stats = writer.stats()
+        return {"megabytes": recorder.total_received / 1048576.0, "seconds": elapsed,
+                "megabytes_per_second": recorder.total_received / 1048576.0 / elapsed,
+                "writes": stats["writes"], "opens": stats["opens"]}
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(location, ignore_errors=True)
+
+
+def record_station(timeline, speed, icy, workers):
+    """
+    Record the whole timeline with a Station and post-process it, returns where it was recorded,
+    when recording stopped, when post-processing finished, the server's request counts and the seconds
+    from starting the station to its first byte of audio.
+    """
+    server = FakeIcecast(timeline, speed=speed).start()
+    file_path = tempfile.mkdtemp(prefix="pyss-bench-")
+    PYSS.FILE_PATH = file_path
+    post = PYSS.PostProcessor(workers)
+    config = {"stream_url": server.url + "stream", "xsl_location": PYSS.extract_xsl_from_link(server.url + "stream"),
+              "dj_url": server.url, "dj_element": "#dj", "dj_img_element": "#dj-art", "np_element": "#np",
+              "file_path": file_path, "icy_metadata": icy, "live_silence": timeline.tones}
+    station = PYSS.Station("bench", config, quiet=True, post=post)
+    thread = threading.Thread(target=station.run)
+    thread.daemon = True
+    started = time.time()
+    thread.start()
+    deadline = started + timeline.duration() / speed + STOP_MARGIN
+    while time.time() < deadline and thread.is_alive():
+        time.sleep(.1)
+    stopped = time.time()
+    station.stop()
+    thread.join()
+    post.join()
+    finished = time.time()
+    server.shutdown()
+    server.server_close()
+    first_byte = station.first_byte - station.started if station.first_byte else None
+    return file_path, stopped, finished, dict(server.requests), first_byte
+
+
+def read_blocks(file_path):
+    """
+    (location, block offset, records) for every recorded block in order, the offset is where the block
+    starts in the stream since blocks continue each other at their end position.
+    """
+    blocks = []
+    offset = 0
+    for name in sorted(os.listdir(file_path)):
+        cue_path = os.path.join(file_path, name, PYSS.CUE_FILE_NAME)
+        if not os.path.isfile(cue_path):
+            continue
+        records = list(PYSS.read_cue(cue_path))
+        blocks.append((os.path.dirname(cue_path), offset, records))
+        ends = [record["position"] for record in records if record["type"] == "end"]
+        offset += ends[-1] if ends else 0
+    return blocks
+
+
+def end_to_end(blocks, stopped, finished):
+    """
+    Seconds from the end of every song in the stream to its file being written by post-processing.
+    """
+    latencies = []
+    missing = 0
+    for location, offset, records in blocks:
+        block = [record for record in records if record["type"] == "block"][0]
+        for record in records:
+            if record["type"] != "song" or not record["complete"]:
+                continue
+            destination = PYSS.SongData.from_record(record, block, location).split()[-1].destination_file
+            if os.path.isfile(destination):
+                latencies.append(os.path.getmtime(destination) - record["end_time"])
+            else:
+                missing += 1
+    return {"song_latency_seconds": summarise(latencies), "missing_songs": missing,
+            "drain_seconds": finished - stopped}
+
+
+def boundary_accuracy(blocks, timeline):
+    """
+    Error of every detected song boundary against the scripted one, in seconds. With live_silence, cut_error
+    is how far the cut landed from the silence closing the track, 0 when it is inside it.
+    """
+    detected = []
+    for location, offset, records in blocks:
+        for record in records:
+            if record["type"] == "song" and offset + record["start_position"] > 0:
+                detected.append((offset + record["start_position"],
+                                 offset + record["cut_start"] if record.get("cut_start") is not None else None))
+    truth = timeline.ground_truth()
+    tolerance = min(track["duration"] for track in timeline.script) * BYTES_PER_SECOND / 2
+    errors = []
+    cut_errors = []
+    matched = set()
+    for position, cut in detected:
+        nearest = min(truth, key=lambda boundary: abs(boundary["position"] - position))
+        if abs(nearest["position"] - position) > tolerance:
+            continue
+        matched.add(nearest["position"])
+        errors.append(abs(position - nearest["position"]) / float(BYTES_PER_SECOND))
+        if cut is not None:
+            silence_start, silence_end = nearest["silence"]
+            cut_errors.append(max(silence_start - cut, cut - silence_end, 0) / float(BYTES_PER_SECOND))
+    return {"boundaries": len(truth), "detected": len(detected), "missed": len(truth) - len(matched),
+            "spurious": len(detected) - len(errors), "error_seconds": summarise(errors),
+            "cut_error_seconds": summarise(cut_errors)}
+
+
+def bench_station(timeline, speed, icy, workers):
+    file_path, stopped, finished, requests, first_byte = record_station(timeline, speed, icy, workers)
+    try:
+        blocks = read_blocks(file_path)
+        return {"blocks": len(blocks), "requests": requests, "first_byte_seconds": first_byte,
+                "end_to_end": end_to_end(blocks, stopped, finished),
+                "boundary_accuracy": boundary_accuracy(blocks, timeline)}
+    finally:
+        shutil.rmtree(file_path, ignore_errors=True)
+
+
+def flatten(data, prefix=""):
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, "%s%s." % (prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(old_path, new_path):
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    with open(new_path) as new_file:
+        new = json.load(new_file)
+    sys.stdout.write("%s (%s) -> %s (%s)\n" % (old["version"], old["revision"], new["version"], new["revision"]))
+    old_values = flatten(old["benchmarks"])
+    new_values = flatten(new["benchmarks"])
+    for key in sorted(set(old_values) | set(new_values)):
+        before = old_values.get(key)
+        after = new_values.get(key)
+        change = ""
+        if before and after is not None:
+            change = "%+.1f%%" % ((after - before) * 100.0 / before)
+        sys.stdout.write("%-60s %12s %12s %9s\n" % (key, before, after, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PYSS against a local fake Icecast server.")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="times real time the scripted station plays at, faster makes polling less accurate")
+    parser.add_argument("--modes", default="status,icy", help="title sources to record with, status and/or icy")
+    parser.add_argument("--throughput", type=float, default=64, help="megabytes streamed for recorder throughput")
+    parser.add_argument("--workers", type=int, default=PYSS.POST_WORKERS)
+    parser.add_argument("--silent", action="store_true", help="don't encode tones with ffmpeg")
+    parser.add_argument("--output", default=RESULTS_DIR)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    timeline = Timeline(tones=not args.silent)
+    results = {"version": PYSS.VERSION, "revision": git_revision(), "time": time.time(),
+               "python": platform.python_version(), "platform": platform.platform(),
+               "settings": {"speed": args.speed, "workers": args.workers, "tones": timeline.tones,
+                            "timeline_seconds": timeline.duration()},
+               "benchmarks": {}}
+    sys.stdout.write("Recorder throughput..\n")
+    results["benchmarks"]["recorder_throughput"] = bench_recorder_throughput(args.throughput)
+    for mode in args.modes.split(","):
+        sys.stdout.write("Recording the scripted station with %s titles, %.0fs..\n" % (
+            mode, timeline.duration() / args.speed + STOP_MARGIN))
+        results["benchmarks"]["station_%s" % mode] = bench_station(timeline, args.speed, mode == "icy", args.workers)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    path = os.path.join(args.output, "%s-%d.json" % (PYSS.VERSION, results["time"]))
+    with open(path, "w") as result_file:
+        json.dump(results, result_file, indent=2, sort_keys=True)
+    sys.stdout.write(json.dumps(results["benchmarks"], indent=2, sort_keys=True))
+    sys.stdout.write("\nSaved to %s\n" % path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+# Checks of the stream and cue parsing that need neither ffmpeg nor the fake Icecast server:
+#   python -m unittest discover -s tests
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import PYSS
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MPEG1_HEADER = "\xff\xfb\x90\x00"  # MPEG-1 Layer III, 128kbps, 44.1kHz, no CRC
+MPEG1_PADDED_HEADER = "\xff\xfb\x92\x00"
+MPEG2_HEADER = "\xff\xf3\x80\x00"  # MPEG-2 Layer III, 64kbps, 22.05kHz, no CRC
+MPEG2_PADDED_HEADER = "\xff\xf3\x82\x00"
+
+
+def frame(header, side_info=""):
+    """
+    A frame of the length header gives, its side info followed by zeros.
+    """
+    length = PYSS.mpeg_frame_length(header)
+    return header + side_info + "\0" * (length - len(header) - len(side_info))
+
+
+def metadata(title):
+    """
+    An icy metadata block, its length byte followed by StreamTitle padded to a multiple of 16 bytes.
+    """
+    text = "StreamTitle='%s';" % title
+    blocks = (len(text) + 15) // 16
+    return chr(blocks) + text + "\0" * (blocks * 16 - len(text))
+
+
+class IcyMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.audio = ["".join(chr(65 + part) for _ in range(16)) for part in range(4)]
+        self.stream = (self.audio[0] + metadata("A - One") + self.audio[1] + "\0" + self.audio[2] +
+                       metadata("B - Two") + self.audio[3])
+
+    def test_whole_stream(self):
+        audio, titles = PYSS.IcyMetadataParser(16).feed(self.stream)
+        self.assertEqual(audio, "".join(self.audio))
+        self.assertEqual(titles, [(16, u"A - One", True), (48, u"B - Two", False)])
+
+    def test_split_in_metadata(self):
+        parser = PYSS.IcyMetadataParser(16)
+        # Cut inside the length byte's block, then inside the second title
+        cut, second_cut = 20, len(self.stream) - 30
+        audio, titles = parser.feed(self.stream[:cut])
+        self.assertEqual((audio, titles), (self.audio[0], []))
+        audio, titles = parser.feed(self.stream[cut:second_cut])
+        self.assertEqual(audio, self.audio[1] + self.audio[2])
+        self.assertEqual(titles, [(0, u"A - One", True)])
+        audio, titles = parser.feed(self.stream[second_cut:])
+        self.assertEqual(audio, self.audio[3])
+        self.assertEqual(titles, [(0, u"B - Two", False)])
+
+    def test_byte_at_a_time(self):
+        parser = PYSS.IcyMetadataParser(16)
+        audio = []
+        titles = []
+        for byte in self.stream:
+            part, found = parser.feed(byte)
+            audio.append(part)
+            titles += [title for offset, title, first in found]
+        self.assertEqual("".join(audio), "".join(self.audio))
+        self.assertEqual(titles, [u"A - One", u"B - Two"])
+
+    def test_repeated_title(self):
+        parser = PYSS.IcyMetadataParser(16)
+        audio, titles = parser.feed(self.audio[0] + metadata("A - One") + self.audio[1] + metadata("A - One"))
+        self.assertEqual(titles, [(16, u"A - One", True)])
+
+
+class MpegFrameTest(unittest.TestCase):
+    def test_frame_length(self):
+        self.assertEqual(PYSS.mpeg_frame_length(MPEG1_HEADER), 417)
+        self.assertEqual(PYSS.mpeg_frame_length(MPEG1_PADDED_HEADER), 418)
+        # MPEG-2 Layer III frames hold 576 samples, half of MPEG-1's
+        self.assertEqual(PYSS.mpeg_frame_length(MPEG2_HEADER), 208)
+        self.assertEqual(PYSS.mpeg_frame_length(MPEG2_PADDED_HEADER), 209)
+
+    def test_invalid_header(self):
+        self.assertEqual(PYSS.mpeg_frame_length("\xff\xfb\x90"), 0)
+        self.assertEqual(PYSS.mpeg_frame_length("\xfe\xfb\x90\x00"), 0)
+        # Reserved version, free and bad bitrates, reserved sample rate
+        self.assertEqual(PYSS.mpeg_frame_length("\xff\xeb\x90\x00"), 0)
+        self.assertEqual(PYSS.mpeg_frame_length("\xff\xfb\x00\x00"), 0)
+        self.assertEqual(PYSS.mpeg_frame_length("\xff\xfb\xf0\x00"), 0)
+        self.assertEqual(PYSS.mpeg_frame_length("\xff\xfb\x9c\x00"), 0)
+
+    def test_find_frame_skips_false_sync(self):
+        frames = frame(MPEG2_PADDED_HEADER) + frame(MPEG2_HEADER) + frame(MPEG2_PADDED_HEADER)
+        # A header whose next frame isn't there is taken for a sync word in the audio
+        data = "junk" + MPEG1_HEADER + "\0" * 10 + frames
+        self.assertEqual(PYSS.find_frame(data), 18)
+        self.assertEqual(PYSS.find_frame(data, 19), 18 + 209)
+        self.assertEqual(PYSS.find_frame("no frames here\xff"), -1)
+
+    def test_find_frame_at_the_end(self):
+        # The last header can't be checked against a next one, so it is taken as it is
+        data = "\0" * 5 + MPEG1_PADDED_HEADER + "\0" * 100
+        self.assertEqual(PYSS.find_frame(data), 5)
+
+    def test_silent_frames(self):
+        self.assertTrue(PYSS.mpeg_frame_silent(frame(MPEG1_HEADER)))
+        self.assertTrue(PYSS.mpeg_frame_silent(frame(MPEG2_PADDED_HEADER)))
+        self.assertFalse(PYSS.mpeg_frame_silent(frame(MPEG1_HEADER, "\xff" * 32)))
+        self.assertFalse(PYSS.mpeg_frame_silent(frame(MPEG2_HEADER, "\xff" * 17)))
+
+    def test_silence_watcher(self):
+        loud = frame(MPEG1_HEADER, "\xff" * 32)
+        # Four 26ms frames pass SILENCE_CHECK, fed in pieces that split frames and headers
+        data = loud + frame(MPEG1_HEADER) * 4 + loud + frame(MPEG1_PADDED_HEADER) * 2
+        watcher = PYSS.SilenceWatcher()
+        found = [watcher.feed(data[i:i + 101]) for i in range(0, len(data), 101)]
+        self.assertEqual(found.count(True), 1)
+        self.assertEqual(watcher.silent, 2 * 1152 / 44100.0)
+
+
+@unittest.skipIf(numpy is None, "numpy isn't installed")
+class FindSilenceTest(unittest.TestCase):
+    RATE = 1000  # samples per second, so one sample per ms
+
+    def signal(self, *parts):
+        """
+        Samples from (ms, level) parts.
+        """
+        return numpy.concatenate([numpy.full(ms, level, dtype=numpy.float32) for ms, level in parts])
+
+    def test_end_of_silence(self):
+        samples = self.signal((1000, .5), (200, 0.0), (1000, .5))
+        self.assertEqual(PYSS.find_silence(samples, self.RATE, 1100), 1200)
+
+    def test_closest_silence(self):
+        samples = self.signal((500, .5), (200, 0.0), (1000, .5), (300, 0.0), (500, .5))
+        self.assertEqual(PYSS.find_silence(samples, self.RATE, 800), 700)
+        self.assertEqual(PYSS.find_silence(samples, self.RATE, 1700), 2000)
+
+    def test_short_or_no_silence(self):
+        self.assertIsNone(PYSS.find_silence(self.signal((1000, .5), (50, 0.0), (1000, .5)), self.RATE, 1000))
+        self.assertIsNone(PYSS.find_silence(self.signal((2000, .5)), self.RATE, 1000))
+        self.assertIsNone(PYSS.find_silence(self.signal((5, 0.0)), self.RATE, 0))
+
+    def test_quiet_noise_is_silence(self):
+        # Below SILENCE_THRESHOLD
+        samples = self.signal((1000, .5), (200, 1e-5), (1000, .5))
+        self.assertEqual(PYSS.find_silence(samples, self.RATE, 1000), 1200)
+
+
+class ReadCueTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cue_path = os.path.join(self.folder, PYSS.CUE_FILE_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, records, trailing=""):
+        with open(self.cue_path, "w") as cue:
+            for record in records:
+                cue.write(json.dumps(record) + "\n")
+            cue.write(trailing)
+
+    def test_truncated_trailing_line(self):
+        records = [{"type": "block", "version": PYSS.CUE_VERSION, "dj": None},
+                   {"type": "song", "index": 1, "title": "A - One"}]
+        self.write(records, trailing='{"type": "song", "index": 2, "tit')
+        self.assertEqual(list(PYSS.read_cue(self.cue_path)), records)
+
+    def test_complete_record_without_newline(self):
+        # Still being written until its newline is there
+        records = [{"type": "block", "version": PYSS.CUE_VERSION, "dj": None}]
+        self.write(records, trailing=json.dumps({"type": "end", "position": 10}))
+        self.assertEqual(list(PYSS.read_cue(self.cue_path)), records)
+
+    def test_other_version(self):
+        self.write([{"type": "block", "version": PYSS.CUE_VERSION + 1, "dj": None}])
+        self.assertRaises(PYSS.CueFormatException, list, PYSS.read_cue(self.cue_path))
+
+
+if __name__ == "__main__":
+    unittest.main()